@@ -46,7 +46,9 @@ export const Upload = forwardRef<
         };
       })
 
-      await fetch(`${env.NEXT_PUBLIC_BACKEND_URL}/upload`, {
+      // Lets progress events from /events be matched to this upload
+      const uploadId = `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+      await fetch(`${env.NEXT_PUBLIC_BACKEND_URL}/upload?upload=${uploadId}`, {
         method: "POST",
         body: formData,
       })
@@ -1,19 +1,94 @@
 "use client";
 
-import React, { createContext, useContext, useState } from "react";
+import { useAuthContext } from "@/app/context/AuthContext";
+import { env } from "@/env";
+import React, { createContext, useCallback, useContext, useEffect, useRef, useState } from "react";
+
+export interface FileRecord {
+  id: string
+  name: string
+  size: number
+  hmac: string
+  created_at: string
+}
+
+export type FileEvent =
+  | { type: "upload"; seq: number; file: FileRecord }
+  | { type: "delete"; seq: number; id: string }
+  | { type: "progress"; upload: string | null; name: string; stage: "received" | "stored"; size: number }
+  | { type: "reset" };
+
+type SyncMessage = { type: "sync"; epoch: string; seq: number; resumed: boolean };
 
 interface FileEventContextProps {
   fileUploaded: string | null;
   setFileUploaded: (uploaded: string | null) => void;
+  subscribe: (listener: (event: FileEvent) => void) => () => void;
 }
 
 const FileEventContext = createContext<FileEventContextProps | undefined>(undefined);
 
 export const FileEventProvider: React.FC<{ children: React.ReactNode }> = ({ children }) => {
   const [fileUploaded, setFileUploaded] = useState<string | null>(null);
+  const { id: userId } = useAuthContext();
+  const listenersRef = useRef(new Set<(event: FileEvent) => void>());
+
+  const subscribe = useCallback((listener: (event: FileEvent) => void) => {
+    listenersRef.current.add(listener);
+    return () => {
+      listenersRef.current.delete(listener);
+    };
+  }, []);
+
+  useEffect(() => {
+    if (!userId) return;
+
+    const emit = (event: FileEvent) => listenersRef.current.forEach((listener) => listener(event));
+    let socket: WebSocket | null = null;
+    let retry: ReturnType<typeof setTimeout> | null = null;
+    let attempts = 0;
+    let epoch: string | null = null;
+    let seq = 0;
+    let closed = false;
+
+    const connect = () => {
+      const params = epoch ? `?since=${seq}&epoch=${epoch}` : "";
+      socket = new WebSocket(`${env.NEXT_PUBLIC_BACKEND_URL.replace(/^http/, "ws")}/events${params}`);
+
+      socket.onmessage = (message: MessageEvent) => {
+        const data = JSON.parse(message.data as string) as FileEvent | SyncMessage;
+        if (data.type === "sync") {
+          attempts = 0;
+          // The server restarted or we missed too much, the list has to be refetched
+          if (epoch && !data.resumed) emit({ type: "reset" });
+          epoch = data.epoch;
+          // On resume the missed events follow and advance seq one by one
+          if (!data.resumed) seq = data.seq;
+          return;
+        }
+        if (data.type === "upload" || data.type === "delete") {
+          if (data.seq <= seq) return;
+          seq = data.seq;
+        }
+        emit(data);
+      };
+
+      socket.onclose = () => {
+        if (closed) return;
+        retry = setTimeout(connect, Math.min(30000, 500 * 2 ** attempts++));
+      };
+    };
+
+    connect();
+    return () => {
+      closed = true;
+      if (retry) clearTimeout(retry);
+      socket?.close();
+    };
+  }, [userId]);
 
   return (
-    <FileEventContext.Provider value={{ fileUploaded, setFileUploaded }}>
+    <FileEventContext.Provider value={{ fileUploaded, setFileUploaded, subscribe }}>
       {children}
     </FileEventContext.Provider>
   );
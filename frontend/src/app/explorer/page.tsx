@@ -34,7 +34,7 @@ export default function FileExplorerPage() {
   const [isDecrypting, setIsDecrypting] = useState(false);
   const [mimeType, setMimeType] = useState<string | null>(null);
   const [confirmDelete, setConfirmDelete] = useState(false);
-  const { fileUploaded, setFileUploaded } = useFileEventContext();
+  const { fileUploaded, setFileUploaded, subscribe } = useFileEventContext();
   const urlCopiedRef = useRef<HTMLDivElement | null>(null);
   const fetchControllerRef = useRef<AbortController | null>(null);
   const { id: userId, isLoading: isAuthLoading } = useAuthContext();
@@ -163,7 +163,7 @@ export default function FileExplorerPage() {
         method: "DELETE",
       });
       if (response.ok) {
-        void fetchFiles();
+        setFiles((files) => files.filter((f) => f.id !== fileId));
         setSelectedFile(null);
         setFileContent(null);
         setMimeType(null);
@@ -317,11 +317,30 @@ export default function FileExplorerPage() {
     void fetchFiles();
   }, []);
 
+  useEffect(() => {
+    return subscribe((event) => {
+      if (event.type === "upload") {
+        setFiles((files) => [...files.filter((f) => f.id !== event.file.id), event.file]);
+      } else if (event.type === "delete") {
+        setFiles((files) => files.filter((f) => f.id !== event.id));
+        setSelectedFile((selected) => selected?.id === event.id ? null : selected);
+      } else if (event.type === "reset") {
+        void fetchFiles();
+      }
+    });
+  }, [subscribe]);
+
   useEffect(() => {
     if (fileUploaded) {
+      // The upload event usually lands before the upload response does
+      const file = files.find((f) => f.id === fileUploaded);
+      if (file) {
+        setSelectedFile(file);
+        setFileUploaded(null);
+        return;
+      }
       fetchFiles().then((data: File[] | undefined) => {
-        if (!data) return;
-        const file = data.find((f) => f.id === fileUploaded);
+        const file = data?.find((f) => f.id === fileUploaded);
         if (file) {
           setSelectedFile(file);
         }
@@ -6,8 +6,10 @@ import os
 
 from fastapi import HTTPException, Request
 from pydantic import BaseModel
+from starlette.requests import HTTPConnection
 
 HMAC_SECRET = bytes.fromhex(os.environ.get("HMAC_SECRET", "secret"))
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
 
 
 class UserAuth(BaseModel):
@@ -46,7 +48,7 @@ def digest_token(token: str) -> UserAuth:
         raise ValueError(f"Invalid token: {e}")
 
 
-def use_auth(request: Request) -> UserAuth:
+def use_auth(request: HTTPConnection) -> UserAuth:
     token = request.cookies.get("auth_token")
     if not token:
         raise HTTPException(status_code=403, detail="Unauthorized")
@@ -57,3 +59,13 @@ def use_auth(request: Request) -> UserAuth:
         raise HTTPException(status_code=401, detail="Invalid token")
 
     return user
+
+
+def use_admin(request: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    expected = f"Bearer {ADMIN_TOKEN}".encode("utf-8")
+    provided = request.headers.get("Authorization", "").encode("utf-8")
+    if not hmac.compare_digest(provided, expected):
+        raise HTTPException(status_code=401, detail="Invalid token")
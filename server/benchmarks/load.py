@@ -0,0 +1,377 @@
+"""Load test of the FastAPI app against in-process stand-in shards.
+
+Every CHUNKS_PER_FILE x REPLICAS combination runs in a fresh child process,
+so peak RSS is reported per configuration. The stand-in shards live in the
+parent process and are recreated for each run. Run from the ``server``
+directory:
+
+    python -m benchmarks.load --shards 5 --chunks 2 3 --replicas 1 2 \\
+        --concurrency 16 --requests 200 --sizes 10k:6,1m:3,20m:1 \\
+        --output bench.json --compare previous-bench.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from http.cookies import SimpleCookie
+from itertools import product
+from typing import Any
+
+UNITS = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+
+
+def parse_size(value: str) -> int:
+    value = value.strip().lower()
+    unit = value[-1] if value[-1] in UNITS else ""
+    return int(float(value[: len(value) - len(unit)]) * UNITS[unit])
+
+
+def parse_mix(value: str) -> list[tuple[int, float]]:
+    mix = []
+    for item in value.split(","):
+        size, _, weight = item.partition(":")
+        mix.append((parse_size(size), float(weight or 1)))
+    return mix
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+async def asgi_request(
+    app,
+    method: str,
+    path: str,
+    headers: list[tuple[bytes, bytes]] | None = None,
+    body: bytes = b"",
+) -> tuple[int, dict[bytes, bytes], bytes]:
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "https",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", b"bench"), *(headers or [])],
+        "client": ("127.0.0.1", 0),
+        "server": ("bench", 443),
+    }
+    sent = False
+    status = 500
+    response_headers: dict[bytes, bytes] = {}
+    response_body = bytearray()
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            await asyncio.Event().wait()
+        sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            response_headers.update(message.get("headers", []))
+        elif message["type"] == "http.response.body":
+            response_body.extend(message.get("body", b""))
+
+    try:
+        await app(scope, receive, send)
+    except Exception:
+        # The server would log and answer 500, which ServerErrorMiddleware
+        # has already sent before re-raising
+        status = 500
+    return status, response_headers, bytes(response_body)
+
+
+class BenchUser:
+    def __init__(self, app, name: str):
+        self._app = app
+        self._name = name
+        self._cookie = b""
+
+    async def register(self):
+        status, headers, _ = await self.request(
+            "POST",
+            "/api/register",
+            [(b"content-type", b"application/json")],
+            json.dumps({"username": self._name, "password": self._name}).encode(),
+        )
+        cookie = SimpleCookie(headers[b"set-cookie"].decode())
+        self._cookie = f"auth_token={cookie['auth_token'].value}".encode()
+
+    async def request(self, method, path, headers=None, body=b""):
+        headers = list(headers or [])
+        if self._cookie:
+            headers.append((b"cookie", self._cookie))
+        return await asgi_request(self._app, method, path, headers, body)
+
+    async def upload(self, payload: bytes) -> tuple[int, bytes]:
+        boundary = os.urandom(16).hex().encode()
+        body = b"".join(
+            [
+                b"--" + boundary + b"\r\n",
+                b'Content-Disposition: form-data; name="file"; filename="bench.bin"\r\n',
+                b"Content-Type: application/octet-stream\r\n\r\n",
+                payload,
+                b"\r\n--" + boundary + b"--\r\n",
+            ]
+        )
+        status, _, response = await self.request(
+            "POST",
+            "/api/upload",
+            [(b"content-type", b"multipart/form-data; boundary=" + boundary)],
+            body,
+        )
+        return status, response
+
+
+async def drive(app, args) -> dict[str, Any]:
+    mix = parse_mix(args.sizes)
+    sizes, weights = zip(*mix)
+    pool = os.urandom(max(sizes))
+    latencies: dict[str, list[float]] = defaultdict(list)
+    statuses: dict[str, Counter] = defaultdict(Counter)
+    remaining = args.requests
+    transferred = 0
+
+    users = [
+        BenchUser(app, f"bench-{i}-{os.urandom(4).hex()}") for i in range(args.users)
+    ]
+    for user in users:
+        await user.register()
+
+    async def timed(op: str, call):
+        started = time.perf_counter()
+        status, *rest = await call
+        latencies[op].append(time.perf_counter() - started)
+        statuses[op][status] += 1
+        return status, *rest
+
+    async def worker(user: BenchUser):
+        nonlocal remaining, transferred
+        while remaining > 0:
+            remaining -= 1
+            size = random.choices(sizes, weights)[0]
+            # A random prefix keeps concurrent uploads from sharing an HMAC
+            payload = os.urandom(16) + pool[: max(0, size - 16)]
+            status, response = await timed("upload", user.upload(payload))
+            if status != 200:
+                continue
+            transferred += len(payload)
+
+            ulid = json.loads(response)["ulid"]
+            status, _, content = await timed(
+                "download", user.request("GET", f"/api/files/{ulid}")
+            )
+            if status == 200 and len(content) == len(payload):
+                transferred += len(content)
+            else:
+                statuses["download"]["mismatch"] += 1
+
+            await timed("delete", user.request("DELETE", f"/api/files/{ulid}"))
+
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(worker(users[i % len(users)]) for i in range(args.concurrency))
+    )
+    elapsed = time.perf_counter() - started
+
+    return {
+        "chunks_per_file": int(os.environ["CHUNKS_PER_FILE"]),
+        "replicas": int(os.environ["REPLICAS"]),
+        "elapsed_s": elapsed,
+        "iterations_per_s": args.requests / elapsed,
+        "mb_per_s": transferred / elapsed / 1024**2,
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "ops": {
+            op: {
+                "count": len(values),
+                "p50_ms": _ms(percentile(values, 50)),
+                "p95_ms": _ms(percentile(values, 95)),
+                "p99_ms": _ms(percentile(values, 99)),
+                "statuses": {str(k): v for k, v in statuses[op].items()},
+            }
+            for op, values in latencies.items()
+        },
+    }
+
+
+def _ms(value: float | None) -> float | None:
+    return None if value is None else value * 1000
+
+
+async def run_worker(args) -> dict[str, Any]:
+    import logging
+
+    from hub import sharder_hub
+    from server import app
+
+    logging.getLogger().setLevel(logging.WARNING)
+    for shard in args.shard:
+        host, port = shard.rsplit(":", 1)
+        sharder_hub.add_shard(host, int(port))
+
+    async with app.router.lifespan_context(app):
+        return await drive(app, args)
+
+
+def run_config(args, chunks: int, replicas: int) -> dict[str, Any]:
+    from benchmarks.shards import StandInShard
+
+    shards = [
+        StandInShard(
+            latency=args.latency / 1000,
+            bandwidth=args.bandwidth * 1024**2,
+            failure_rate=args.failure_rate,
+        ).start()
+        for _ in range(args.shards)
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {
+            **os.environ,
+            "CHUNKS_PER_FILE": str(chunks),
+            "REPLICAS": str(replicas),
+            "DB_URL": f"sqlite:///{tmp}/bench.sqlite",
+        }
+        env.setdefault("CONNECTION_SECRET", os.urandom(16).hex())
+        command = [sys.executable, "-m", "benchmarks.load", "--worker", *args.argv]
+        for shard in shards:
+            command += ["--shard", f"{shard.host}:{shard.port}"]
+        try:
+            output = subprocess.run(
+                command,
+                env=env,
+                check=True,
+                stdout=subprocess.PIPE,
+            ).stdout
+        finally:
+            for shard in shards:
+                shard.stop()
+
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def git_commit() -> str | None:
+    try:
+        return (
+            subprocess.run(
+                ["git", "rev-parse", "HEAD"],
+                check=True,
+                capture_output=True,
+            )
+            .stdout.decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(results: list[dict[str, Any]], baseline: dict | None):
+    previous = {
+        (r["chunks_per_file"], r["replicas"]): r
+        for r in (baseline or {}).get("results", [])
+    }
+    for result in results:
+        key = (result["chunks_per_file"], result["replicas"])
+        print(
+            f"CHUNKS_PER_FILE={key[0]} REPLICAS={key[1]}: "
+            f"{result['iterations_per_s']:.2f} it/s, {result['mb_per_s']:.2f} MB/s, "
+            f"peak RSS {result['peak_rss_bytes'] / 1024**2:.1f} MB"
+            + _delta(result, previous.get(key), "mb_per_s")
+        )
+        for op, stats in result["ops"].items():
+            print(
+                f"  {op:<9} n={stats['count']:<5} p50={stats['p50_ms']:.1f}ms "
+                f"p95={stats['p95_ms']:.1f}ms p99={stats['p99_ms']:.1f}ms "
+                f"statuses={stats['statuses']}"
+            )
+
+
+def _delta(result: dict, baseline: dict | None, field: str) -> str:
+    if not baseline or not baseline.get(field):
+        return ""
+    change = (result[field] - baseline[field]) / baseline[field] * 100
+    return f" ({change:+.1f}% {field} vs baseline)"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, default=5)
+    parser.add_argument("--chunks", type=int, nargs="+", default=[3])
+    parser.add_argument("--replicas", type=int, nargs="+", default=[2])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument(
+        "--sizes",
+        default="10k:6,1m:3,10m:1",
+        help="Comma separated size:weight mix, e.g. 10k:6,1m:3,10m:1",
+    )
+    parser.add_argument("--latency", type=float, default=0, help="Shard latency, ms")
+    parser.add_argument("--bandwidth", type=float, default=0, help="Shard MB/s")
+    parser.add_argument("--failure-rate", type=float, default=0)
+    parser.add_argument("--output", help="Write JSON results to this file")
+    parser.add_argument("--compare", help="Previous JSON results to compare with")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--shard", action="append", default=[], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    os.environ.setdefault("HMAC_SECRET", os.urandom(16).hex())
+    if args.worker:
+        print(json.dumps(asyncio.run(run_worker(args))))
+        return
+
+    worker_flags = ("--chunks", "--replicas", "--output", "--compare")
+    args.argv = []
+    skip = False
+    for arg in sys.argv[1:]:
+        if arg.startswith("--"):
+            skip = arg.split("=")[0] in worker_flags
+        if not skip:
+            args.argv.append(arg)
+
+    results = [
+        run_config(args, chunks, replicas)
+        for chunks, replicas in product(args.chunks, args.replicas)
+    ]
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now(datetime.UTC).isoformat(),
+        "settings": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("worker", "shard", "argv", "output", "compare")
+        },
+        "results": results,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print_summary(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""Replay a trace written by ``TRACE_PATH`` against a running stack.
+
+Requests are re-issued at their recorded offsets divided by ``--speed``, with
+random payloads of the recorded sizes, each traced user getting an account of
+its own. Files that the trace downloads or deletes without uploading them
+first are uploaded before the clock starts.
+Run from the ``server`` directory:
+
+    python -m benchmarks.replay trace.jsonl --url http://localhost:8000 --speed 4
+    python -m benchmarks.replay trace.jsonl --unix-socket ../socks/nginx.sock
+"""
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit
+
+from benchmarks.load import percentile
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+
+class Client:
+    def __init__(self, url: str | None, unix_socket: str | None, timeout: float):
+        self._url = urlsplit(url or "http://localhost")
+        self._unix_socket = unix_socket
+        self._timeout = timeout
+        self._local = threading.local()
+        self.cookie = ""
+
+    def _connection(self) -> http.client.HTTPConnection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if self._unix_socket:
+                connection = UnixHTTPConnection(self._unix_socket, self._timeout)
+            elif self._url.scheme == "https":
+                connection = http.client.HTTPSConnection(
+                    self._url.netloc, timeout=self._timeout
+                )
+            else:
+                connection = http.client.HTTPConnection(
+                    self._url.netloc, timeout=self._timeout
+                )
+            self._local.connection = connection
+        return connection
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        body: bytes | None = None,
+        headers: dict[str, str] | None = None,
+    ) -> tuple[int, http.client.HTTPMessage, bytes]:
+        headers = dict(headers or {})
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        connection = self._connection()
+        try:
+            connection.request(method, self._url.path.rstrip("/") + path, body, headers)
+            response = connection.getresponse()
+            return response.status, response.headers, response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self._local.connection = None
+            raise
+
+    def login(self):
+        name = f"replay-{os.urandom(8).hex()}"
+        _, headers, _ = self.request(
+            "POST",
+            "/api/register",
+            json.dumps({"username": name, "password": name}).encode(),
+            {"Content-Type": "application/json"},
+        )
+        cookie = SimpleCookie(headers["Set-Cookie"])
+        self.cookie = f"auth_token={cookie['auth_token'].value.strip(chr(34))}"
+
+    def upload(self, size: int) -> tuple[int, str | None]:
+        boundary = os.urandom(16).hex()
+        body = b"".join(
+            [
+                f"--{boundary}\r\n".encode(),
+                b'Content-Disposition: form-data; name="file"; filename="replay.bin"\r\n',
+                b"Content-Type: application/octet-stream\r\n\r\n",
+                os.urandom(size),
+                f"\r\n--{boundary}--\r\n".encode(),
+            ]
+        )
+        status, _, response = self.request(
+            "POST",
+            "/api/upload",
+            body,
+            {"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        )
+        if status != 200:
+            return status, None
+        return status, json.loads(response)["ulid"]
+
+
+def file_keys(record: dict) -> list[str]:
+    if "file" in record:
+        return [record["file"]]
+    return record.get("files", [])
+
+
+def load_trace(path: str) -> list[dict]:
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return sorted(records, key=lambda record: record["t"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("trace")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--unix-socket")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    records = load_trace(args.trace)
+    if not records:
+        print("Trace is empty")
+        return
+
+    # One account per traced user, so per-user budgets and queues apply as
+    # they did when the trace was recorded
+    clients: dict[str, Client] = {}
+    for user in {r.get("user", "") for r in records}:
+        clients[user] = Client(args.url, args.unix_socket, args.timeout)
+        clients[user].login()
+
+    # Map every file key in the trace to a file on the replay stack, owned by
+    # the user that first touches it
+    files: dict[str, str] = {}
+    owners: dict[str, str] = {}
+    sizes: dict[str, int] = defaultdict(int)
+    for r in records:
+        for key in file_keys(r):
+            owners.setdefault(key, r.get("user", ""))
+        if "file" in r:
+            sizes[r["file"]] = max(sizes[r["file"]], r.get("size", 0))
+    uploaded = {r["file"] for r in records if r["op"] == "upload" and "file" in r}
+    for key in owners.keys() - uploaded:
+        _, ulid = clients[owners[key]].upload(sizes[key])
+        if ulid:
+            files[key] = ulid
+
+    # Later operations on a file wait until its replayed upload has finished
+    ready = {key: threading.Event() for key in uploaded}
+    latencies: dict[str, list[float]] = defaultdict(list)
+    statuses: dict[str, Counter] = defaultdict(Counter)
+    lag: list[float] = []
+    lock = threading.Lock()
+
+    def issue(record: dict, due: float):
+        lag.append(max(0.0, time.perf_counter() - due))
+        operation = record["op"]
+        key = record.get("file")
+        client = clients[record.get("user", "")]
+        if operation != "upload":
+            for waiting in file_keys(record):
+                if waiting in ready:
+                    ready[waiting].wait(args.timeout)
+        started = time.perf_counter()
+        try:
+            if operation == "upload":
+                try:
+                    status, ulid = client.upload(record.get("size", 0))
+                    if ulid and key:
+                        with lock:
+                            files[key] = ulid
+                finally:
+                    if key in ready:
+                        ready[key].set()
+            elif operation == "list":
+                status, _, _ = client.request("GET", "/api/files")
+            elif operation in ("archive", "bulk_delete"):
+                ids = [files[k] for k in record.get("files", ()) if k in files]
+                if not ids:
+                    status = "unknown_file"
+                else:
+                    query = "&".join(f"id={file_id}" for file_id in ids)
+                    if operation == "archive":
+                        status, _, _ = client.request("GET", f"/api/archive?{query}")
+                    else:
+                        status, _, _ = client.request("DELETE", f"/api/files?{query}")
+            elif key not in files:
+                status = "unknown_file"
+            elif operation == "download":
+                status, _, _ = client.request("GET", f"/api/files/{files[key]}")
+            else:
+                status, _, _ = client.request("DELETE", f"/api/files/{files[key]}")
+        except (OSError, http.client.HTTPException):
+            status = "error"
+        with lock:
+            latencies[operation].append(time.perf_counter() - started)
+            statuses[operation][str(status)] += 1
+
+    origin = records[0]["t"]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.workers) as executor:
+        for record in records:
+            due = started + (record["t"] - origin) / args.speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(issue, record, due)
+    elapsed = time.perf_counter() - started
+
+    results = {
+        "trace": args.trace,
+        "speed": args.speed,
+        "requests": len(records),
+        "users": len(clients),
+        "elapsed_s": elapsed,
+        "recorded_s": (records[-1]["t"] - origin) / args.speed,
+        "p99_start_lag_ms": (percentile(lag, 99) or 0) * 1000,
+        "ops": {
+            op: {
+                "count": len(values),
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "statuses": dict(statuses[op]),
+            }
+            for op, values in latencies.items()
+        },
+    }
+
+    print(
+        f"Replayed {len(records)} requests in {elapsed:.1f}s "
+        f"(trace span {results['recorded_s']:.1f}s at {args.speed}x, "
+        f"p99 start lag {results['p99_start_lag_ms']:.1f}ms)"
+    )
+    for op, stats in results["ops"].items():
+        print(
+            f"  {op:<11} n={stats['count']:<5} p50={stats['p50_ms']:.1f}ms "
+            f"p95={stats['p95_ms']:.1f}ms p99={stats['p99_ms']:.1f}ms "
+            f"statuses={stats['statuses']}"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
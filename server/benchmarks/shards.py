@@ -0,0 +1,141 @@
+"""In-process stand-ins for the C++ shard, speaking the same 0x01-0x05 protocol."""
+
+import random
+import socket
+import struct
+import threading
+import time
+
+from hub import _recv_exact, _send_all
+
+
+class StandInShard:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        bandwidth: float = 0.0,
+        failure_rate: float = 0.0,
+    ):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self._chunks: dict[tuple[bytes, int], bytes] = {}
+        self._lock = threading.Lock()
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.listen(128)
+        self.host, self.port = self._sock.getsockname()
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            return sum(len(chunk) for chunk in self._chunks.values())
+
+    def start(self) -> "StandInShard":
+        threading.Thread(target=self._serve, daemon=True).start()
+        return self
+
+    def _serve(self):
+        while True:
+            try:
+                client, _ = self._sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(client,), daemon=True).start()
+
+    def _delay(self, size: int):
+        delay = self.latency
+        if self.bandwidth:
+            delay += size / self.bandwidth
+        if delay:
+            time.sleep(delay)
+
+    def _handle(self, client: socket.socket):
+        with client:
+            try:
+                opcode = _recv_exact(client, 1)
+                if opcode is None:
+                    return
+
+                if opcode[0] != 0x04 and random.random() < self.failure_rate:
+                    return
+
+                if opcode[0] == 0x01:
+                    self._store(client)
+                elif opcode[0] == 0x02:
+                    self._retrieve(client)
+                elif opcode[0] == 0x03:
+                    self._delete(client)
+                elif opcode[0] == 0x04:
+                    client.sendall(struct.pack(">I", self.size & 0xFFFFFFFF))
+                elif opcode[0] == 0x05:
+                    self._delete_batch(client)
+            except OSError:
+                pass
+
+    def _store(self, client: socket.socket):
+        header = _recv_exact(client, 10)
+        if header is None:
+            return
+        index, hmac_len, data_len = struct.unpack(">IHI", header)
+        file_hmac = _recv_exact(client, hmac_len)
+        chunk = _recv_exact(client, data_len)
+        if file_hmac is None or chunk is None:
+            client.sendall(b"\x00")
+            return
+
+        self._delay(data_len)
+        with self._lock:
+            self._chunks[bytes(file_hmac), index] = bytes(chunk)
+        client.sendall(b"\x01")
+
+    def _retrieve(self, client: socket.socket):
+        header = _recv_exact(client, 6)
+        if header is None:
+            return
+        index, hmac_len = struct.unpack(">IH", header)
+        file_hmac = _recv_exact(client, hmac_len)
+        with self._lock:
+            chunk = self._chunks.get((bytes(file_hmac or b""), index))
+        if chunk is None:
+            client.sendall(b"\x00")
+            return
+
+        self._delay(len(chunk))
+        _send_all(client, [b"\x01" + struct.pack(">I", len(chunk)), chunk])
+
+    def _delete(self, client: socket.socket):
+        header = _recv_exact(client, 2)
+        if header is None:
+            return
+        (hmac_len,) = struct.unpack(">H", header)
+        file_hmac = bytes(_recv_exact(client, hmac_len) or b"")
+        self._delay(0)
+        client.sendall(b"\x01" if self._drop(file_hmac) else b"\x00")
+
+    def _delete_batch(self, client: socket.socket):
+        header = _recv_exact(client, 2)
+        if header is None:
+            return
+        (count,) = struct.unpack(">H", header)
+        statuses = bytearray()
+        for _ in range(count):
+            header = _recv_exact(client, 2)
+            if header is None:
+                return
+            (hmac_len,) = struct.unpack(">H", header)
+            file_hmac = bytes(_recv_exact(client, hmac_len) or b"")
+            statuses.append(0x01 if self._drop(file_hmac) else 0x00)
+        self._delay(0)
+        client.sendall(statuses)
+
+    def _drop(self, file_hmac: bytes) -> bool:
+        with self._lock:
+            keys = [key for key in self._chunks if key[0] == file_hmac]
+            for key in keys:
+                del self._chunks[key]
+        return bool(keys)
+
+    def stop(self):
+        self._sock.close()
@@ -0,0 +1,358 @@
+"""Offline placement and capacity simulator for a virtual shard cluster.
+
+Files are cut with ``hub.chunk_size`` and every chunk is offered to shards in
+a uniformly random order until REPLICAS of them accept it, which is what
+``hub.placement_order`` does for ``SharderHub.send``. The default placement
+draws those orders for a whole batch of chunks at once with numpy, ``--exact``
+calls ``hub.placement_order`` for every chunk instead (slow, for checking).
+
+With ``--trace``, uploads are sampled from a TRACE_PATH recording, and a file
+whose traced upload was later deleted or bulk deleted in the same trace is
+deleted after the same delay. Traced files that outlive the recording fall back
+to ``--lifetime-days``.
+
+A shard accepts a chunk while it is healthy and has free capacity, judged at
+the start of each batch of ``--batch`` chunks. Shards fail at ``--failure-rate``
+per day, losing their chunks; ``--replace`` brings them back empty and
+``--repair`` re-replicates lost copies straight away. Requires numpy. Run from
+the ``server`` directory:
+
+    python -m benchmarks.simulate --shards 12 --capacity 2t --chunks 3 \\
+        --replicas 2 --days 90 --uploads-per-day 200000 --size-median 2m \\
+        --lifetime-days 30 --failure-rate 0.002 --replace --repair
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    sys.exit("benchmarks.simulate requires numpy: pip install numpy")
+
+os.environ.setdefault("HMAC_SECRET", os.urandom(16).hex())
+
+import hub
+from benchmarks.load import parse_size
+from benchmarks.replay import file_keys, load_trace
+
+
+class Cluster:
+    def __init__(self, capacities: np.ndarray, replicas: int, rng, exact: bool):
+        self.capacity = capacities.astype(np.int64)
+        self.fill = np.zeros(len(capacities), dtype=np.int64)
+        self.healthy = np.ones(len(capacities), dtype=bool)
+        self.replicas = replicas
+        self.rng = rng
+        self.exact = exact
+        self.owners = np.empty((0, replicas), dtype=np.int32)
+        self.copies = np.empty(0, dtype=np.int8)
+        self.sizes = np.empty(0, dtype=np.int64)
+        self.files = np.empty(0, dtype=np.int64)
+        self.expires = np.empty(0, dtype=np.float64)
+        self.alive = np.empty(0, dtype=bool)
+
+    def place(self, sizes: np.ndarray, exclude: np.ndarray | None = None):
+        """Pick up to ``replicas`` shards per chunk, -1 where none accepted."""
+        wanted = (
+            self.replicas
+            if exclude is None
+            else self.replicas - ((exclude >= 0).sum(axis=1))
+        )
+        accept = self.healthy & (self.fill + sizes.max(initial=0) <= self.capacity)
+        if self.exact:
+            return self._place_exact(sizes, accept, exclude, wanted)
+
+        keys = self.rng.random((len(sizes), len(self.fill)))
+        keys[:, ~accept] = np.inf
+        if exclude is not None:
+            rows, cols = np.nonzero(exclude >= 0)
+            keys[rows, exclude[rows, cols]] = np.inf
+
+        order = np.argsort(keys, axis=1)[:, : self.replicas]
+        taken = np.take_along_axis(keys, order, axis=1) < np.inf
+        taken &= np.arange(order.shape[1]) < np.reshape(wanted, (-1, 1))
+        owners = np.where(taken, order, -1).astype(np.int32)
+        # Fewer shards than replicas, the missing copies count as a shortfall
+        missing = self.replicas - owners.shape[1]
+        return np.pad(owners, ((0, 0), (0, missing)), constant_values=-1)
+
+    def _place_exact(self, sizes, accept, exclude, wanted):
+        shards = list(range(len(self.fill)))
+        owners = np.full((len(sizes), self.replicas), -1, dtype=np.int32)
+        wanted = np.broadcast_to(wanted, len(sizes))
+        for row in range(len(sizes)):
+            skip = set() if exclude is None else set(exclude[row].tolist())
+            sent = 0
+            for shard in hub.placement_order(shards):
+                if sent >= wanted[row]:
+                    break
+                if accept[shard] and shard not in skip:
+                    owners[row, sent] = shard
+                    sent += 1
+        return owners
+
+    def _account(self, owners: np.ndarray, sizes: np.ndarray, sign: int = 1):
+        held = owners >= 0
+        weights = np.broadcast_to(sizes[:, None], owners.shape)[held]
+        self.fill += sign * np.bincount(
+            owners[held], weights=weights, minlength=len(self.fill)
+        ).astype(np.int64)
+
+    def upload(self, sizes, files, expires, batch: int) -> int:
+        """Store chunks and return how many replicas could not be placed."""
+        placed = []
+        for start in range(0, len(sizes), batch):
+            owners = self.place(sizes[start : start + batch])
+            self._account(owners, sizes[start : start + batch])
+            placed.append(owners)
+        owners = np.concatenate([np.empty((0, self.replicas), np.int32), *placed])
+        copies = (owners >= 0).sum(axis=1).astype(np.int8)
+        self.owners = np.concatenate([self.owners, owners])
+        self.copies = np.concatenate([self.copies, copies])
+        self.sizes = np.concatenate([self.sizes, sizes])
+        self.files = np.concatenate([self.files, files])
+        self.expires = np.concatenate([self.expires, expires])
+        self.alive = np.concatenate([self.alive, np.ones(len(sizes), dtype=bool)])
+        return int(len(sizes) * self.replicas - copies.sum())
+
+    def delete_expired(self, now: float) -> int:
+        due = self.alive & (self.expires <= now)
+        self._account(self.owners[due], self.sizes[due], -1)
+        self.alive &= ~due
+        return int(self.sizes[due].sum())
+
+    def fail(self, shard: int, replace: bool) -> tuple[int, np.ndarray]:
+        """Drop every copy held by ``shard``, return lost bytes and rows hit."""
+        hit = self.alive & (self.owners == shard).any(axis=1)
+        self.owners[self.owners == shard] = -1
+        self.copies[hit] -= 1
+        self.fill[shard] = 0
+        self.healthy[shard] = replace
+        return int(self.sizes[hit].sum()), np.nonzero(hit)[0]
+
+    def repair(self, rows: np.ndarray, batch: int) -> int:
+        """Copy missing replicas of ``rows`` to other shards, return bytes moved."""
+        moved = 0
+        for start in range(0, len(rows), batch):
+            part = rows[start : start + batch]
+            current = self.owners[part]
+            held = (current >= 0).sum(axis=1)
+            # Lost chunks have no copy left to repair from
+            part, current, held = part[held > 0], current[held > 0], held[held > 0]
+            extra = self.place(self.sizes[part], exclude=current)
+            self._account(extra, self.sizes[part])
+            merged = np.concatenate([current, extra], axis=1)
+            merged = -np.sort(-merged, axis=1)[:, : self.replicas]
+            self.owners[part] = merged
+            self.copies[part] += (extra >= 0).sum(axis=1).astype(np.int8)
+            moved += int(((extra >= 0).sum(axis=1) * self.sizes[part]).sum())
+        return moved
+
+    def compact(self):
+        if len(self.alive) and self.alive.mean() < 0.5:
+            keep = self.alive
+            self.owners = self.owners[keep]
+            self.copies = self.copies[keep]
+            self.sizes = self.sizes[keep]
+            self.files = self.files[keep]
+            self.expires = self.expires[keep]
+            self.alive = self.alive[keep]
+
+    def snapshot(self) -> dict:
+        # Bytes of live chunks by how many copies of them are left
+        by_copies = np.bincount(
+            self.copies,
+            weights=np.where(self.alive, self.sizes, 0),
+            minlength=self.replicas + 1,
+        )
+        logical = int(by_copies.sum())
+        lost_files = 0
+        if by_copies[0]:
+            lost = self.alive & (self.copies == 0) & (self.sizes > 0)
+            lost_files = len(np.unique(self.files[lost]))
+        fill = self.fill[self.healthy]
+        mean = fill.mean() if len(fill) else 0
+        return {
+            "chunks": int(np.count_nonzero(self.alive)),
+            "logical_bytes": logical,
+            "stored_bytes": int(self.fill.sum()),
+            "storage_overhead": float(self.fill.sum() / logical) if logical else 0,
+            "fill_skew": float(fill.max() / mean) if mean else 0,
+            "fill_cv": float(fill.std() / mean) if mean else 0,
+            "max_fill_ratio": float(
+                (self.fill / self.capacity)[self.healthy].max(initial=0)
+            ),
+            "healthy_shards": int(self.healthy.sum()),
+            "bytes_at_risk": int(by_copies[1]),
+            "under_replicated_bytes": int(by_copies[: self.replicas].sum()),
+            "lost_bytes": int(by_copies[0]),
+            "lost_files": lost_files,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, default=10)
+    parser.add_argument(
+        "--capacity",
+        default="1t",
+        help="Capacity of every shard, or a comma separated list per shard",
+    )
+    parser.add_argument("--chunks", type=int, default=hub.CHUNKS_PER_FILE)
+    parser.add_argument("--replicas", type=int, default=hub.REPLICAS)
+    parser.add_argument("--days", type=float, default=30)
+    parser.add_argument("--step-hours", type=float, default=24)
+    parser.add_argument("--uploads-per-day", type=float, default=10000)
+    parser.add_argument("--size-median", default="1m")
+    parser.add_argument("--size-sigma", type=float, default=1.5)
+    parser.add_argument(
+        "--lifetime-days",
+        type=float,
+        default=0,
+        help="Mean time until a file is deleted, 0 keeps files forever",
+    )
+    parser.add_argument(
+        "--trace",
+        help="Sample upload sizes, rate and time until deletion from a "
+        "TRACE_PATH recording",
+    )
+    parser.add_argument("--failure-rate", type=float, default=0, help="Per shard/day")
+    parser.add_argument("--replace", action="store_true")
+    parser.add_argument("--repair", action="store_true")
+    parser.add_argument("--exact", action="store_true")
+    parser.add_argument("--batch", type=int, default=65536)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", help="Write JSON timeline to this file")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    capacities = [parse_size(c) for c in args.capacity.split(",")]
+    if len(capacities) == 1:
+        capacities *= args.shards
+    cluster = Cluster(np.array(capacities), args.replicas, rng, args.exact)
+
+    trace_sizes = None
+    uploads_per_day = args.uploads_per_day
+    if args.trace:
+        records = load_trace(args.trace)
+        uploads = [r for r in records if r["op"] == "upload"]
+        deleted = {}
+        for r in records:
+            if r["op"] in ("delete", "bulk_delete"):
+                for key in file_keys(r):
+                    deleted.setdefault(key, r["t"])
+        trace_sizes = np.array([r.get("size", 0) for r in uploads], dtype=np.int64)
+        # Days until the trace deletes each uploaded file, inf if it never does
+        trace_lifetimes = np.array(
+            [
+                (
+                    max(0, deleted[r["file"]] - r["t"]) / 86400
+                    if r.get("file") in deleted
+                    else np.inf
+                )
+                for r in uploads
+            ]
+        )
+        span = (uploads[-1]["t"] - uploads[0]["t"]) / 86400 if uploads else 0
+        if span and "--uploads-per-day" not in sys.argv:
+            uploads_per_day = len(uploads) / span
+
+    step = args.step_hours / 24
+    totals = {
+        "uploaded_bytes": 0,
+        "deleted_bytes": 0,
+        "write_shortfall_replicas": 0,
+        "failures": 0,
+        "rereplication_bytes": 0,
+        "repaired_bytes": 0,
+    }
+    timeline = []
+    next_file = 0
+    started = time.perf_counter()
+
+    for index in range(math.ceil(args.days / step)):
+        now = index * step
+        totals["deleted_bytes"] += cluster.delete_expired(now)
+
+        count = rng.poisson(uploads_per_day * step)
+        lifetimes = np.full(count, np.inf)
+        if trace_sizes is not None and len(trace_sizes):
+            picks = rng.integers(len(trace_sizes), size=count)
+            sizes = trace_sizes[picks]
+            lifetimes = trace_lifetimes[picks]
+        else:
+            median = parse_size(args.size_median)
+            sizes = rng.lognormal(math.log(median), args.size_sigma, count)
+            sizes = sizes.astype(np.int64)
+        files = np.arange(next_file, next_file + count)
+        next_file += count
+        when = now + rng.random(count) * step
+        if args.lifetime_days:
+            lifetimes = np.where(
+                np.isinf(lifetimes),
+                rng.exponential(args.lifetime_days, count),
+                lifetimes,
+            )
+        expires = when + lifetimes
+
+        # Same cut as SharderHub.send, including empty trailing chunks
+        length = hub.chunk_size(sizes, args.chunks)
+        pieces = np.stack(
+            [np.clip(sizes - i * length, 0, length) for i in range(args.chunks)],
+            axis=1,
+        ).ravel()
+        totals["uploaded_bytes"] += int(sizes.sum())
+        totals["write_shortfall_replicas"] += cluster.upload(
+            pieces,
+            np.repeat(files, args.chunks),
+            np.repeat(expires, args.chunks),
+            args.batch,
+        )
+
+        probability = 1 - math.exp(-args.failure_rate * step)
+        for shard in np.nonzero(
+            cluster.healthy & (rng.random(args.shards) < probability)
+        )[0]:
+            totals["failures"] += 1
+            lost, rows = cluster.fail(int(shard), args.replace)
+            totals["rereplication_bytes"] += lost
+            if args.repair:
+                totals["repaired_bytes"] += cluster.repair(rows, args.batch)
+
+        cluster.compact()
+        timeline.append({"day": now + step, **cluster.snapshot(), **totals})
+
+    elapsed = time.perf_counter() - started
+    final = timeline[-1] if timeline else {}
+    print(
+        f"Simulated {args.days:g} days, {next_file} uploads "
+        f"in {elapsed:.1f}s (CHUNKS_PER_FILE={args.chunks}, REPLICAS={args.replicas})"
+    )
+    for key, value in final.items():
+        print(
+            f"  {key:<26} {value:,.3f}"
+            if isinstance(value, float)
+            else f"  {key:<26} {value:,}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "settings": vars(args),
+                    "elapsed_s": elapsed,
+                    "uploads": next_file,
+                    "timeline": timeline,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Microbenchmark of the hub's shard wire I/O.
+
+Compares the previous copy-based framing (``payload = header + chunk`` on
+send, ``chunk += part`` on receive) against the ``sendmsg``/``recv_into``
+helpers in ``hub``. Run from the ``server`` directory:
+
+    python -m benchmarks.wire --sizes 1 4 16 --rounds 5
+"""
+
+import argparse
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import tracemalloc
+from typing import Callable
+
+os.environ.setdefault("HMAC_SECRET", os.urandom(16).hex())
+
+from hub import _recv_exact, _send_all
+
+MB = 1024 * 1024
+
+
+def legacy_send(sock: socket.socket, header: bytes, chunk: bytes):
+    sock.sendall(header + chunk)
+
+
+def legacy_recv(sock: socket.socket, size: int) -> bytes | None:
+    chunk = b""
+    while len(chunk) < size:
+        part = sock.recv(min(4096, size - len(chunk)))
+        if not part:
+            return None
+        chunk += part
+    return chunk
+
+
+def zero_copy_send(sock: socket.socket, header: bytes, chunk: bytes):
+    _send_all(sock, [header, chunk])
+
+
+def zero_copy_recv(sock: socket.socket, size: int) -> bytearray | None:
+    return _recv_exact(sock, size)
+
+
+def _drain(sock: socket.socket):
+    buffer = bytearray(1 << 20)
+    while sock.recv_into(buffer):
+        pass
+
+
+def _feed(sock: socket.socket, data: bytes):
+    sock.sendall(data)
+    sock.shutdown(socket.SHUT_WR)
+
+
+def _measure(run: Callable[[], None]) -> tuple[float, int]:
+    tracemalloc.start()
+    started = time.process_time()
+    run()
+    elapsed = time.process_time() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def bench_send(send, chunk: bytes) -> tuple[float, int]:
+    header = b"\x01" + struct.pack(">IHI", 0, 32, len(chunk)) + os.urandom(32)
+    left, right = socket.socketpair()
+    drainer = threading.Thread(target=_drain, args=(right,))
+    drainer.start()
+    try:
+
+        def run():
+            send(left, header, chunk)
+            left.shutdown(socket.SHUT_WR)
+
+        return _measure(run)
+    finally:
+        drainer.join()
+        left.close()
+        right.close()
+
+
+def bench_recv(recv, chunk: bytes) -> tuple[float, int]:
+    left, right = socket.socketpair()
+    feeder = threading.Thread(target=_feed, args=(right, chunk))
+    feeder.start()
+    try:
+        result = None
+
+        def run():
+            nonlocal result
+            result = recv(left, len(chunk))
+
+        measured = _measure(run)
+        assert result is not None and len(result) == len(chunk)
+        return measured
+    finally:
+        feeder.join()
+        left.close()
+        right.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="Print JSON results")
+    args = parser.parse_args()
+
+    results = []
+    for size_mb in args.sizes:
+        chunk = os.urandom(size_mb * MB)
+        for direction, legacy, zero_copy, bench in (
+            ("send", legacy_send, zero_copy_send, bench_send),
+            ("recv", legacy_recv, zero_copy_recv, bench_recv),
+        ):
+            for name, fn in (("legacy", legacy), ("zero_copy", zero_copy)):
+                runs = [bench(fn, chunk) for _ in range(args.rounds)]
+                cpu = min(cpu for cpu, _ in runs)
+                peak = min(peak for _, peak in runs)
+                results.append(
+                    {
+                        "direction": direction,
+                        "impl": name,
+                        "size_mb": size_mb,
+                        "cpu_ms_per_mb": cpu * 1000 / size_mb,
+                        "peak_alloc_bytes_per_mb": peak / size_mb,
+                    }
+                )
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'dir':<5} {'impl':<10} {'MB':>4} {'cpu ms/MB':>10} {'alloc B/MB':>12}")
+    for r in results:
+        print(
+            f"{r['direction']:<5} {r['impl']:<10} {r['size_mb']:>4} "
+            f"{r['cpu_ms_per_mb']:>10.3f} {r['peak_alloc_bytes_per_mb']:>12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
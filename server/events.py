@@ -0,0 +1,73 @@
+import asyncio
+import os
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Iterator
+
+FILE_EVENTS_HISTORY = int(os.environ.get("FILE_EVENTS_HISTORY", 256))
+FILE_EVENTS_BUFFER = int(os.environ.get("FILE_EVENTS_BUFFER", 256))
+
+
+class FileEventBus:
+    """Per-user stream of file list deltas with a short replay history.
+
+    Upload and delete events get a per-user sequence number and are kept so a
+    reconnecting client can resume from the last one it saw. Progress events
+    only reach connected clients. State lives in this process, and ``epoch``
+    changes on every restart so clients know old sequence numbers are void.
+    """
+
+    def __init__(self, history: int, buffer: int):
+        self.epoch = os.urandom(8).hex()
+        self._buffer = buffer
+        self._seq: dict[str, int] = defaultdict(int)
+        self._history: dict[str, deque[dict]] = defaultdict(
+            lambda: deque(maxlen=history)
+        )
+        self._subscribers: dict[str, set[asyncio.Queue]] = defaultdict(set)
+
+    def seq(self, user_id: str) -> int:
+        return self._seq.get(user_id, 0)
+
+    def publish(self, user_id: str, event: dict, replayable: bool = True):
+        if replayable:
+            self._seq[user_id] += 1
+            event = {**event, "seq": self._seq[user_id]}
+            self._history[user_id].append(event)
+
+        for queue in list(self._subscribers.get(user_id, ())):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Too far behind, ``None`` tells the subscriber to go and resume
+                self._subscribers[user_id].discard(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def since(self, user_id: str, epoch: str, seq: int) -> list[dict] | None:
+        """Events after ``seq``, or ``None`` when the client must refetch."""
+        current = self.seq(user_id)
+        if epoch != self.epoch or seq > current:
+            return None
+        if seq == current:
+            return []
+
+        history = self._history.get(user_id)
+        if not history or history[0]["seq"] > seq + 1:
+            return None
+        return [event for event in history if event["seq"] > seq]
+
+    @contextmanager
+    def subscribe(self, user_id: str) -> Iterator[asyncio.Queue]:
+        queue: asyncio.Queue[dict | None] = asyncio.Queue(self._buffer)
+        self._subscribers[user_id].add(queue)
+        try:
+            yield queue
+        finally:
+            self._subscribers[user_id].discard(queue)
+            if not self._subscribers[user_id]:
+                del self._subscribers[user_id]
+
+
+file_events = FileEventBus(FILE_EVENTS_HISTORY, FILE_EVENTS_BUFFER)
@@ -5,18 +5,119 @@ import os
 import random
 import socket
 import struct
+import threading
 import time
-from typing import Literal
+from contextlib import contextmanager, suppress
+from typing import Iterator, Literal
 
 from pydantic import BaseModel
-from prometheus_client import Summary
+from prometheus_client import Counter, Gauge, Histogram
+
+from recorder import annotate, record_shard
+from telemetry import mark_failed, span, stage
 
 CHUNKS_PER_FILE = int(os.environ.get("CHUNKS_PER_FILE", 3))
 REPLICAS = int(os.environ.get("REPLICAS", 2))
 HMAC_SECRET = bytes.fromhex(os.environ.get("HMAC_SECRET", "secret"))
+SHARD_CONCURRENCY = int(os.environ.get("SHARD_CONCURRENCY", 4))
+SHARD_QUEUE_TIMEOUT = float(os.environ.get("SHARD_QUEUE_TIMEOUT", 0.5))
+SHARD_WAIT_TIMEOUT = float(os.environ.get("SHARD_WAIT_TIMEOUT", 30))
+# Hashes per 0x05 message, the count field is 16 bits
+DESTROY_BATCH = 1024
+
+size_occupied = Gauge("sharder_size_occupied", "Total size occupied on all shards")
+avg_size = Gauge("sharder_avg_size", "Average space occupied across shards")
+shard_queue_time = Histogram(
+    "sharder_shard_queue_seconds",
+    "Time spent waiting for a shard connection slot",
+    ["shard"],
+)
+shard_slots_in_use = Gauge(
+    "sharder_shard_slots_in_use",
+    "Connection slots currently held per shard",
+    ["shard"],
+)
+shard_busy = Counter(
+    "sharder_shard_busy",
+    "Shard operations skipped because every slot was held",
+    ["shard"],
+)
+
+shard_operation_time = Histogram(
+    "sharder_shard_operation_seconds",
+    "Time spent per phase of a shard operation",
+    ["shard", "opcode", "phase"],
+)
+shard_bytes_sent = Counter(
+    "sharder_shard_bytes_sent",
+    "Bytes written to shard connections",
+    ["shard"],
+)
+shard_bytes_received = Counter(
+    "sharder_shard_bytes_received",
+    "Bytes read from shard connections",
+    ["shard"],
+)
+shard_failures = Counter(
+    "sharder_shard_failures",
+    "Failed shard operations by reason",
+    ["shard", "opcode", "reason"],
+)
+
+_SHARD_METRICS = (
+    shard_queue_time,
+    shard_slots_in_use,
+    shard_busy,
+    shard_bytes_sent,
+    shard_bytes_received,
+)
+_OPCODES = ("store", "retrieve", "delete", "delete_batch")
+_PHASES = ("connect", "send", "recv", "ack")
+_FAILURE_REASONS = (
+    "busy",
+    "timeout",
+    "refused",
+    "connection",
+    "nack",
+    "not_found",
+    "incomplete",
+    "error",
+)
+
+
+class ShardBusy(RuntimeError):
+    pass
+
+
+class ShardNack(RuntimeError):
+    pass
+
 
-size_occupied = Summary("sharder_size_occupied", "Total size occupied on all shards")
-avg_size = Summary("sharder_avg_size", "Average space occupied across shards")
+def _failure_reason(error: BaseException) -> str:
+    if isinstance(error, ShardBusy):
+        return "busy"
+    if isinstance(error, ShardNack):
+        return "nack"
+    if isinstance(error, TimeoutError):
+        return "timeout"
+    if isinstance(error, ConnectionRefusedError):
+        return "refused"
+    if isinstance(error, (ConnectionError, OSError)):
+        return "connection"
+    return "error"
+
+
+def _forget_shard_metrics(shard: str):
+    for metric in _SHARD_METRICS:
+        with suppress(KeyError):
+            metric.remove(shard)
+    for opcode in _OPCODES:
+        for phase in _PHASES:
+            with suppress(KeyError):
+                shard_operation_time.remove(shard, opcode, phase)
+        for reason in _FAILURE_REASONS:
+            with suppress(KeyError):
+                shard_failures.remove(shard, opcode, reason)
 
 
 class ShardStatus(BaseModel):
@@ -26,14 +127,89 @@ class ShardStatus(BaseModel):
     last_heartbeat: float = 0
 
 
+def _send_all(sock: socket.socket, buffers: list[bytes | memoryview]):
+    """Gather-write ``buffers`` to ``sock`` without concatenating them first."""
+    views = [memoryview(buffer).cast("B") for buffer in buffers if len(buffer)]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if views and sent:
+            views[0] = views[0][sent:]
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytearray | None:
+    """Read exactly ``size`` bytes into a preallocated buffer, ``None`` on EOF."""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        read = sock.recv_into(view[received:])
+        if not read:
+            return None
+        received += read
+    return buffer
+
+
+def chunk_size(size, chunks: int | None = None):
+    """Length of every chunk but the last for a file of ``size`` bytes.
+
+    Only uses arithmetic operators, so it also works on numpy arrays.
+    """
+    chunks = chunks or CHUNKS_PER_FILE
+    return (size + chunks - 1) // chunks
+
+
+def placement_order(shards: list[str]) -> list[str]:
+    """Order in which shards are offered a chunk until REPLICAS accept it."""
+    return random.sample(shards, len(shards))
+
+
+class ShardConnection:
+    """Socket to a single shard that times and counts every exchange."""
+
+    def __init__(self, sock: socket.socket, shard: str, opcode: str):
+        self.sock = sock
+        self.shard = shard
+        self.opcode = opcode
+        self.failure: str | None = None
+
+    def send(self, *buffers: bytes | memoryview):
+        started = time.perf_counter()
+        _send_all(self.sock, list(buffers))
+        shard_operation_time.labels(self.shard, self.opcode, "send").observe(
+            time.perf_counter() - started
+        )
+        shard_bytes_sent.labels(self.shard).inc(sum(len(b) for b in buffers))
+
+    def recv(self, size: int, phase: str = "recv") -> bytearray | None:
+        started = time.perf_counter()
+        data = _recv_exact(self.sock, size)
+        shard_operation_time.labels(self.shard, self.opcode, phase).observe(
+            time.perf_counter() - started
+        )
+        if data is not None:
+            shard_bytes_received.labels(self.shard).inc(size)
+        return data
+
+    def failed(self, reason: str):
+        self.failure = reason
+        shard_failures.labels(self.shard, self.opcode, reason).inc()
+
+
 class SharderHub:
     def __init__(self):
         self._shards = []
         self._status: dict[str, ShardStatus] = {}
+        self._slots: dict[str, threading.BoundedSemaphore] = {}
 
     def add_shard(self, host: str, port: int):
         shard = f"{host}:{port}"
         if shard not in self._shards:
+            self._slots[shard] = threading.BoundedSemaphore(SHARD_CONCURRENCY)
+            for metric in _SHARD_METRICS:
+                metric.labels(shard)
             self._shards.append(shard)
             self._status[shard] = ShardStatus(
                 shard=shard,
@@ -52,49 +228,140 @@ class SharderHub:
             return 200
         return 503
 
+    def _waitable(self, shard: str) -> bool:
+        # Busy shards are worth waiting for unless the healthcheck has seen
+        # them fail, waiting on a hung shard would only pin more threads
+        status = self._status.get(shard)
+        return status is not None and (status.healthy or not status.last_heartbeat)
+
+    @contextmanager
+    def _connect(
+        self,
+        shard: str,
+        operation: str,
+        wait: bool = False,
+    ) -> Iterator[ShardConnection]:
+        # Each shard gets its own slot budget, so a hanging shard can only
+        # pin SHARD_CONCURRENCY threads instead of the whole executor
+        slots = self._slots.get(shard)
+        if slots is None:
+            raise ShardBusy(f"Shard {shard} is not registered")
+
+        started = time.perf_counter()
+        acquired = slots.acquire(
+            timeout=SHARD_WAIT_TIMEOUT if wait else SHARD_QUEUE_TIMEOUT
+        )
+        shard_queue_time.labels(shard).observe(time.perf_counter() - started)
+        if not acquired:
+            shard_busy.labels(shard).inc()
+            if wait:
+                shard_failures.labels(shard, operation, "busy").inc()
+            raise ShardBusy(f"No free connection slot for shard {shard}")
+
+        shard_slots_in_use.labels(shard).inc()
+        started = time.perf_counter()
+        ok = False
+        try:
+            with span(f"sharder.shard.{operation}", shard=shard) as current:
+                host, port = shard.split(":")
+                sock = socket.create_connection((host, int(port)), timeout=5)
+                shard_operation_time.labels(shard, operation, "connect").observe(
+                    time.perf_counter() - started
+                )
+                with sock:
+                    connection = ShardConnection(sock, shard, operation)
+                    yield connection
+                if connection.failure:
+                    mark_failed(current, connection.failure)
+            ok = connection.failure is None
+        except Exception as e:
+            shard_failures.labels(shard, operation, _failure_reason(e)).inc()
+            raise
+        finally:
+            record_shard(shard, operation, time.perf_counter() - started, ok)
+            shard_slots_in_use.labels(shard).dec()
+            slots.release()
+
     def send(self, data: bytes) -> str:
-        chunk_size = (len(data) + CHUNKS_PER_FILE - 1) // CHUNKS_PER_FILE
-        chunks = [
-            data[i * chunk_size : min((i + 1) * chunk_size, len(data))]
-            for i in range(CHUNKS_PER_FILE)
-        ]
-        file_hmac = hmac.new(HMAC_SECRET, data, "sha256").digest()
-
-        for i, chunk in enumerate(chunks):
-            sent = 0
-            for shard in random.sample(self._shards, len(self._shards)):
-                if self._send_chunk(shard, chunk, file_hmac, i):
-                    sent += 1
-                if sent >= REPLICAS:
-                    break
+        with stage("chunking"):
+            view = memoryview(data)
+            size = chunk_size(len(data))
+            chunks = [
+                view[i * size : min((i + 1) * size, len(data))]
+                for i in range(CHUNKS_PER_FILE)
+            ]
+        with stage("hmac"):
+            file_hmac = hmac.new(HMAC_SECRET, data, "sha256").digest()
+        annotate(size=len(data), chunks=len(chunks))
+
+        with stage("fan_out"):
+            for i, chunk in enumerate(chunks):
+                shards = placement_order(self._shards)
+                required = min(REPLICAS, len(shards))
+                sent = self._replicate(shards, chunk, file_hmac, i, required)
+                if not sent or sent < required:
+                    raise RuntimeError(
+                        f"Chunk {i} stored on {sent} of {required} shards"
+                    )
 
         return file_hmac.hex()
 
+    def _replicate(
+        self,
+        shards: list[str],
+        chunk: bytes | memoryview,
+        file_hmac: bytes,
+        index: int,
+        required: int,
+    ) -> int:
+        # Free shards get the chunk first, busy ones are waited on afterwards
+        # instead of being treated as failed
+        sent = 0
+        busy = []
+        for shard in shards:
+            if sent >= required:
+                return sent
+            try:
+                if self._send_chunk(shard, chunk, file_hmac, index):
+                    sent += 1
+            except ShardBusy:
+                busy.append(shard)
+
+        for shard in busy:
+            if sent >= required:
+                break
+            if self._waitable(shard):
+                with suppress(ShardBusy):
+                    if self._send_chunk(shard, chunk, file_hmac, index, True):
+                        sent += 1
+        return sent
+
     def _send_chunk(
         self,
         shard: str,
-        chunk: bytes,
+        chunk: bytes | memoryview,
         file_hmac: bytes,
         index: int,
+        wait: bool = False,
     ) -> bool:
-        host, port = shard.split(":")
         try:
-            with socket.create_connection((host, int(port)), timeout=5) as sock:
-                payload = (
+            with self._connect(shard, "store", wait) as connection:
+                header = (
                     b"\x01"
                     + struct.pack(">IHI", index, len(file_hmac), len(chunk))
                     + file_hmac
-                    + chunk
                 )
-                sock.sendall(payload)
+                connection.send(header, chunk)
                 logging.info(f"Sent chunk {index} to {shard}")
-                header = sock.recv(1)
+                header = connection.recv(1, "ack")
                 if header and header.startswith(b"\x01"):
                     logging.info(f"Chunk {index} sent successfully to {shard}")
                     return True
-                raise RuntimeError(
+                raise ShardNack(
                     f"Failed to send chunk {index} to {shard}: No acknowledgment"
                 )
+        except ShardBusy:
+            raise
         except Exception as e:
             logging.error(f"Failed to send chunk {index} to {shard}: {e}")
 
@@ -104,58 +371,111 @@ class SharderHub:
         file_hmac = bytes.fromhex(file_hmac_hex)
         reconstructed_chunks = []
 
-        for index in range(CHUNKS_PER_FILE):
-            chunk = self._retrieve_chunk(index, file_hmac)
-            if chunk is None:
-                raise RuntimeError(f"Failed to reconstruct chunk {index}")
-            reconstructed_chunks.append(chunk)
+        with stage("fan_in"):
+            for index in range(CHUNKS_PER_FILE):
+                chunk = self.retrieve_chunk(index, file_hmac)
+                if chunk is None:
+                    raise RuntimeError(f"Failed to reconstruct chunk {index}")
+                reconstructed_chunks.append(chunk)
 
-        return b"".join(reconstructed_chunks)
+            contents = b"".join(reconstructed_chunks)
+        annotate(size=len(contents), chunks=len(reconstructed_chunks))
+        return contents
 
-    def _retrieve_chunk(self, index: int, file_hmac: bytes) -> bytes | None:
-        message = b"\x02" + struct.pack(">IH", index, len(file_hmac)) + file_hmac
-        for shard in self._shards:
-            host, port = shard.split(":")
-            logging.debug("Sending %s to %s", message, shard)
+    def retrieve_chunk(self, index: int, file_hmac: bytes) -> bytearray | None:
+        busy = []
+        for shard in list(self._shards):
             try:
-                with socket.create_connection((host, int(port)), timeout=5) as sock:
-                    sock.sendall(message)
-                    header = sock.recv(5)
-                    logging.debug("Got %s from %s", header, host)
-                    if not header or header[0] != 0x01:
-                        continue
-
-                    chunk_size = struct.unpack(">I", header[1:])[0]
-                    chunk = b""
-                    while len(chunk) < chunk_size:
-                        part = sock.recv(min(4096, chunk_size - len(chunk)))
-                        if not part:
-                            break
-                        chunk += part
-
-                    if len(chunk) == chunk_size:
-                        logging.info(
-                            f"Successfully retrieved chunk {index} from {shard}"
-                        )
-                        return chunk
-                    else:
-                        logging.warning(f"Incomplete chunk {index} from {shard}")
-            except Exception as e:
-                logging.error(f"Error retrieving chunk {index} from {shard}: {e}")
+                chunk = self._fetch_chunk(shard, index, file_hmac)
+            except ShardBusy:
+                busy.append(shard)
+                continue
+            if chunk is not None:
+                return chunk
+
+        for shard in busy:
+            if not self._waitable(shard):
+                continue
+            with suppress(ShardBusy):
+                chunk = self._fetch_chunk(shard, index, file_hmac, True)
+                if chunk is not None:
+                    return chunk
+        return None
+
+    def _fetch_chunk(
+        self,
+        shard: str,
+        index: int,
+        file_hmac: bytes,
+        wait: bool = False,
+    ) -> bytearray | None:
+        message = b"\x02" + struct.pack(">IH", index, len(file_hmac)) + file_hmac
+        logging.debug("Sending %s to %s", message, shard)
+        try:
+            with self._connect(shard, "retrieve", wait) as connection:
+                connection.send(message)
+                header = connection.recv(5, "ack")
+                logging.debug("Got %s from %s", header, shard)
+                if not header or header[0] != 0x01:
+                    connection.failed("not_found")
+                    return None
+
+                chunk_size = struct.unpack(">I", header[1:])[0]
+                chunk = connection.recv(chunk_size)
+
+                if chunk is not None:
+                    logging.info(f"Successfully retrieved chunk {index} from {shard}")
+                    return chunk
+                else:
+                    connection.failed("incomplete")
+                    logging.warning(f"Incomplete chunk {index} from {shard}")
+        except ShardBusy:
+            raise
+        except Exception as e:
+            logging.error(f"Error retrieving chunk {index} from {shard}: {e}")
         return None
 
     def destroy(self, file_hmac: bytes):
-        for shard in self._shards:
-            host, port = shard.split(":")
-            try:
-                with socket.create_connection((host, int(port)), timeout=5) as sock:
-                    message = b"\x03" + struct.pack(">H", len(file_hmac)) + file_hmac
-                    sock.sendall(message)
-                    logging.info(f"Deleted file {file_hmac.hex()} from {shard}")
-            except Exception as e:
-                logging.error(
-                    f"Failed to delete file {file_hmac.hex()} from {shard}: {e}"
-                )
+        for shard in list(self._shards):
+            self._destroy_file(shard, file_hmac)
+
+    def _destroy_file(self, shard: str, file_hmac: bytes):
+        try:
+            # A skipped delete leaves the chunks orphaned, so busy shards are waited on
+            with self._connect(shard, "delete", self._waitable(shard)) as connection:
+                message = b"\x03" + struct.pack(">H", len(file_hmac)) + file_hmac
+                connection.send(message)
+                if connection.recv(1, "ack") is None:
+                    raise ShardNack(f"No acknowledgment for {file_hmac.hex()}")
+                logging.info(f"Deleted file {file_hmac.hex()} from {shard}")
+        except Exception as e:
+            logging.error(f"Failed to delete file {file_hmac.hex()} from {shard}: {e}")
+
+    def destroy_many(self, file_hmacs: list[bytes]):
+        """Delete several files with one 0x05 message per shard and batch."""
+        for shard in list(self._shards):
+            for start in range(0, len(file_hmacs), DESTROY_BATCH):
+                batch = file_hmacs[start : start + DESTROY_BATCH]
+                try:
+                    # One buffer, as a buffer per hash would exceed IOV_MAX
+                    message = b"\x05" + struct.pack(">H", len(batch))
+                    message += b"".join(struct.pack(">H", len(h)) + h for h in batch)
+                    with self._connect(
+                        shard, "delete_batch", self._waitable(shard)
+                    ) as connection:
+                        connection.send(message)
+                        if connection.recv(len(batch), "ack") is None:
+                            raise ShardNack(f"Shard {shard} has no batch delete")
+                        logging.info(f"Deleted {len(batch)} files from {shard}")
+                except (ShardNack, ConnectionResetError, BrokenPipeError) as e:
+                    # Shards built before 0x05 drop the connection unanswered
+                    logging.warning(f"{e}, deleting one by one")
+                    for file_hmac in batch:
+                        self._destroy_file(shard, file_hmac)
+                except Exception as e:
+                    logging.error(
+                        f"Failed to delete {len(batch)} files from {shard}: {e}"
+                    )
 
     def healthcheck(self):
         while True:
@@ -185,10 +505,12 @@ class SharderHub:
                         )
                         self._shards.remove(shard)
                         del self._status[shard]
+                        del self._slots[shard]
+                        _forget_shard_metrics(shard)
 
             total_size = sum(status.size for status in self._status.values())
-            size_occupied.observe(total_size)
-            avg_size.observe(total_size / len(self._status) if self._status else 0)
+            size_occupied.set(total_size)
+            avg_size.set(total_size / len(self._status) if self._status else 0)
 
             if os.path.isdir("/file_sd"):
                 with open("/file_sd/shard_targets.json", "w") as f:
@@ -0,0 +1,101 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from types import FrameType
+
+# Only one capture may run at a time, and nothing runs between captures
+_busy = threading.Lock()
+
+
+class ProfilerBusy(RuntimeError):
+    pass
+
+
+def _label(frame: FrameType) -> str:
+    code = frame.f_code
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
+
+
+def _stack(frame: FrameType | None) -> list[str]:
+    stack = []
+    while frame is not None:
+        stack.append(_label(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def sample_stacks(seconds: float, interval: float) -> str:
+    """Sample every thread's stack and return them in collapsed format.
+
+    Each line is ``thread;outer;...;inner count``, ready for flamegraph.pl
+    or speedscope.
+    """
+    if not _busy.acquire(blocking=False):
+        raise ProfilerBusy("Another capture is already running")
+
+    try:
+        me = threading.get_ident()
+        names = {}
+        stacks: Counter[str] = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                thread = names.get(ident, str(ident)).replace(";", ":")
+                stacks[";".join([thread, *_stack(frame)])] += 1
+            time.sleep(interval)
+    finally:
+        _busy.release()
+
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def allocation_diff(seconds: float, limit: int, frames: int) -> str:
+    """Trace allocations for ``seconds`` and return the top growth by line."""
+    if not _busy.acquire(blocking=False):
+        raise ProfilerBusy("Another capture is already running")
+
+    started = not tracemalloc.is_tracing()
+    try:
+        if started:
+            tracemalloc.start(frames)
+        before = tracemalloc.take_snapshot()
+        time.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+        traced, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started:
+            tracemalloc.stop()
+        _busy.release()
+
+    ignore = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+    ]
+    stats = after.filter_traces(ignore).compare_to(
+        before.filter_traces(ignore), "traceback" if frames > 1 else "lineno"
+    )
+
+    lines = [
+        f"traced {traced / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB "
+        f"over {seconds:g}s",
+        f"{'size diff':>12} {'size':>12} {'count diff':>10}  location",
+    ]
+    for stat in stats[:limit]:
+        location = " <- ".join(
+            f"{frame.filename}:{frame.lineno}" for frame in stat.traceback
+        )
+        lines.append(
+            f"{stat.size_diff / 1024:>10.1f}Ki {stat.size / 1024:>10.1f}Ki "
+            f"{stat.count_diff:>10}  {location}"
+        )
+    return "\n".join(lines) + "\n"
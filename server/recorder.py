@@ -0,0 +1,123 @@
+import hashlib
+import json
+import logging
+import queue
+import re
+import threading
+import time
+from contextvars import ContextVar
+
+from starlette.requests import HTTPConnection
+
+from auth import digest_token
+
+_current: ContextVar[dict | None] = ContextVar("trace_record", default=None)
+
+_FILE_PATH = re.compile(r"^/api/files/([^/]+)$")
+
+
+def annotate(**fields):
+    """Attach fields to the trace record of the current request, if any."""
+    record = _current.get()
+    if record is not None:
+        record.update(fields)
+
+
+def record_shard(shard: str, operation: str, seconds: float, ok: bool):
+    record = _current.get()
+    if record is not None:
+        record.setdefault("shards", []).append(
+            [shard, operation, round(seconds, 6), ok]
+        )
+
+
+def file_key(file_id: str) -> str:
+    # Traces identify files only by a short digest so they can be shared
+    return hashlib.blake2b(file_id.encode(), digest_size=6).hexdigest()
+
+
+def user_key(scope) -> str | None:
+    # Same digest for users, so replays keep per-user budgets and queues
+    token = HTTPConnection(scope).cookies.get("auth_token")
+    if not token:
+        return None
+    try:
+        user = digest_token(token)
+    except ValueError:
+        return None
+    return file_key(user.id)
+
+
+def classify(method: str, path: str) -> tuple[str | None, str | None]:
+    if path == "/api/upload" and method == "POST":
+        return "upload", None
+    if path == "/api/files" and method == "GET":
+        return "list", None
+    if path == "/api/files" and method == "DELETE":
+        return "bulk_delete", None
+    if path == "/api/archive" and method == "GET":
+        return "archive", None
+    match = _FILE_PATH.match(path)
+    if match and method == "GET":
+        return "download", match[1]
+    if match and method == "DELETE":
+        return "delete", match[1]
+    return None, None
+
+
+class TraceRecorder:
+    """ASGI middleware appending one JSON line per file operation to ``path``.
+
+    Only sizes, counts and timings are written, never file contents or names,
+    and files and users appear as short digests of their ids.
+    """
+
+    def __init__(self, app, path: str):
+        self.app = app
+        self._queue: queue.SimpleQueue[dict] = queue.SimpleQueue()
+        threading.Thread(target=self._writer, args=(path,), daemon=True).start()
+
+    def _writer(self, path: str):
+        with open(path, "a") as f:
+            while True:
+                record = self._queue.get()
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+                if self._queue.empty():
+                    f.flush()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        operation, file_id = classify(scope["method"], scope["path"])
+        if operation is None:
+            return await self.app(scope, receive, send)
+
+        record: dict = {"t": round(time.time(), 6), "op": operation}
+        if file_id is not None:
+            record["file"] = file_key(file_id)
+        if user := user_key(scope):
+            record["user"] = user
+        token = _current.set(record)
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                record["status"] = message["status"]
+            elif operation == "upload" and message["type"] == "http.response.body":
+                record.setdefault("_body", bytearray()).extend(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            record["dur"] = round(time.perf_counter() - started, 6)
+            body = record.pop("_body", None)
+            if body:
+                try:
+                    record["file"] = file_key(json.loads(body)["ulid"])
+                except (ValueError, KeyError, TypeError):
+                    logging.debug("Upload response carried no ulid")
+            record.setdefault("status", 500)
+            self._queue.put(record)
@@ -0,0 +1,236 @@
+import asyncio
+import contextvars
+import logging
+import math
+import os
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from fastapi import HTTPException
+from prometheus_client import Counter, Gauge
+
+MAX_INFLIGHT_BYTES = int(os.environ.get("MAX_INFLIGHT_BYTES", 512 * 1024 * 1024))
+MAX_USER_INFLIGHT_BYTES = int(
+    os.environ.get("MAX_USER_INFLIGHT_BYTES", MAX_INFLIGHT_BYTES // 4)
+)
+MAX_USER_QUEUED = int(os.environ.get("MAX_USER_QUEUED", 16))
+SCHEDULER_SLOTS = int(
+    os.environ.get("SCHEDULER_SLOTS", min(32, (os.cpu_count() or 1) + 4))
+)
+SCHEDULER_QUANTUM = int(os.environ.get("SCHEDULER_QUANTUM", 1024 * 1024))
+RETRY_AFTER = int(os.environ.get("RETRY_AFTER", 5))
+# Comma separated user_id=weight pairs, users not listed get 1
+SCHEDULER_WEIGHTS = {
+    key.strip(): float(weight)
+    for key, _, weight in (
+        pair.partition("=")
+        for pair in os.environ.get("SCHEDULER_WEIGHTS", "").split(",")
+        if pair.strip()
+    )
+}
+
+inflight_bytes = Gauge("sharder_inflight_bytes", "Bytes admitted and not yet released")
+rejected_requests = Counter(
+    "sharder_rejected_requests",
+    "Requests rejected by admission control",
+    ["reason"],
+)
+queued_operations = Gauge("sharder_queued_operations", "Shard operations waiting")
+running_operations = Gauge("sharder_running_operations", "Shard operations running")
+
+
+class AdmissionController:
+    def __init__(self, budget: int, user_budget: int):
+        self._budget = budget
+        self._user_budget = user_budget
+        self._in_flight = 0
+        self._per_user: dict[str, int] = defaultdict(int)
+
+    @contextmanager
+    def admit(self, key: str, size: int):
+        # A request is always let through when nothing else holds the budget,
+        # so a single file larger than the budget is slow but not impossible
+        held = self._per_user.get(key, 0)
+        if held and held + size > self._user_budget:
+            rejected_requests.labels("user_budget").inc()
+            raise HTTPException(
+                status_code=429,
+                detail="Too many bytes in flight for this user",
+                headers={"Retry-After": str(RETRY_AFTER)},
+            )
+
+        if self._in_flight and self._in_flight + size > self._budget:
+            rejected_requests.labels("global_budget").inc()
+            raise HTTPException(
+                status_code=503,
+                detail="Server is busy",
+                headers={"Retry-After": str(RETRY_AFTER)},
+            )
+
+        self._in_flight += size
+        self._per_user[key] += size
+        inflight_bytes.set(self._in_flight)
+        try:
+            yield
+        finally:
+            self._in_flight -= size
+            self._per_user[key] -= size
+            if not self._per_user[key]:
+                del self._per_user[key]
+            inflight_bytes.set(self._in_flight)
+
+
+@dataclass
+class _Operation:
+    cost: int
+    ready: asyncio.Future = field(repr=False)
+
+
+class FairScheduler:
+    """Deficit round robin over per-user queues of blocking shard operations."""
+
+    def __init__(
+        self,
+        slots: int,
+        quantum: int,
+        max_queued: int,
+        weights: dict[str, float] | None = None,
+    ):
+        self._slots = slots
+        self._quantum = quantum
+        self._max_queued = max_queued
+        self._queues: dict[str, deque[_Operation]] = {}
+        self._deficit: dict[str, int] = {}
+        self._weights = weights or {}
+        for key, weight in self._weights.items():
+            # Zero stalls the event loop while credit trickles in, a negative
+            # weight never earns enough to run
+            if not (weight > 0 and math.isfinite(weight)):
+                raise ValueError(f"Scheduler weight for {key} must be positive")
+        self._round: deque[str] = deque()
+        self._running = 0
+
+    async def run(self, key: str, cost: int, func: Callable[..., Any], *args) -> Any:
+        queue = self._queues.get(key)
+        if queue is not None and len(queue) >= self._max_queued:
+            rejected_requests.labels("user_queue").inc()
+            raise HTTPException(
+                status_code=429,
+                detail="Too many queued operations for this user",
+                headers={"Retry-After": str(RETRY_AFTER)},
+            )
+
+        loop = asyncio.get_running_loop()
+        operation = _Operation(cost=cost, ready=loop.create_future())
+        if queue is None:
+            queue = self._queues[key] = deque()
+            self._deficit[key] = 0
+            self._round.append(key)
+        queue.append(operation)
+        queued_operations.inc()
+        self._dispatch()
+
+        try:
+            await operation.ready
+        except asyncio.CancelledError:
+            if operation.ready.cancelled():
+                self._discard(key, operation)
+            else:
+                self._release()
+            raise
+
+        # Copy the context so hub calls can report into the request trace
+        context = contextvars.copy_context()
+        future = loop.run_in_executor(None, context.run, func, *args)
+        # The slot is held until the thread is done, even if the caller is
+        # cancelled meanwhile, or SCHEDULER_SLOTS could be oversubscribed
+        future.add_done_callback(self._finished)
+        return await asyncio.shield(future)
+
+    def _finished(self, future: asyncio.Future):
+        if not future.cancelled():
+            # Nobody may be awaiting it anymore, mark the error as retrieved
+            future.exception()
+        self._release()
+
+    def _release(self):
+        self._running -= 1
+        running_operations.set(self._running)
+        self._dispatch()
+
+    def _discard(self, key: str, operation: _Operation):
+        queue = self._queues.get(key)
+        if queue is None or operation not in queue:
+            return
+        queue.remove(operation)
+        queued_operations.dec()
+        if not queue:
+            self._forget(key)
+
+    def _forget(self, key: str):
+        del self._queues[key]
+        del self._deficit[key]
+        self._round.remove(key)
+
+    def _credit(self, key: str) -> int:
+        return int(self._quantum * self._weights.get(key, 1.0)) or 1
+
+    def _skip_rounds(self):
+        # Rounds in which nobody can afford their next operation only add
+        # credit, so grant all but the last of them at once
+        rounds = math.inf
+        for key in self._round:
+            operation = self._queues[key][0]
+            if operation.ready.done():
+                return
+            needed = operation.cost - self._deficit[key]
+            rounds = min(rounds, math.ceil(needed / self._credit(key)))
+        if rounds > 1:
+            for key in self._round:
+                self._deficit[key] += (rounds - 1) * self._credit(key)
+
+    def _dispatch(self):
+        blocked = 0
+        while self._running < self._slots and self._round:
+            key = self._round[0]
+            queue = self._queues[key]
+            operation = queue[0]
+            if operation.ready.done():
+                # Cancelled while waiting, its owner will not claim the slot
+                queue.popleft()
+                queued_operations.dec()
+                if not queue:
+                    self._forget(key)
+                blocked = 0
+                continue
+
+            if self._deficit[key] < operation.cost:
+                if not blocked:
+                    self._skip_rounds()
+                blocked += 1
+                self._deficit[key] += self._credit(key)
+                self._round.rotate(-1)
+                continue
+
+            blocked = 0
+            self._deficit[key] -= operation.cost
+            queue.popleft()
+            queued_operations.dec()
+            if not queue:
+                self._forget(key)
+
+            self._running += 1
+            running_operations.set(self._running)
+            operation.ready.set_result(None)
+            logging.debug(f"Scheduled operation for {key} ({operation.cost} bytes)")
+
+
+admission = AdmissionController(MAX_INFLIGHT_BYTES, MAX_USER_INFLIGHT_BYTES)
+scheduler = FairScheduler(
+    SCHEDULER_SLOTS,
+    SCHEDULER_QUANTUM,
+    MAX_USER_QUEUED,
+    SCHEDULER_WEIGHTS,
+)
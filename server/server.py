@@ -4,21 +4,25 @@ import datetime
 import json
 import logging
 import os
-from contextlib import asynccontextmanager
+import zipfile
+from collections import deque
+from contextlib import asynccontextmanager, suppress
 from threading import Thread
 from typing import Annotated
 
 import bcrypt
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import magic
 from fastapi import (
     Depends,
     FastAPI,
     File,
     HTTPException,
+    Query,
     Response,
     UploadFile,
     WebSocket,
+    WebSocketDisconnect,
 )
 from fastapi.middleware.cors import CORSMiddleware
 from prometheus_client import Gauge, Summary
@@ -26,12 +30,17 @@ from prometheus_fastapi_instrumentator import Instrumentator
 from pydantic import BaseModel
 from sqlalchemy import and_, func
 
-from auth import UserAuth, generate_token, use_auth
+from auth import UserAuth, generate_token, use_admin, use_auth
 from db import File as FileModel
 from db import SessionLocal
 from db import User as UserModel
 from db import init_db
-from hub import sharder_hub
+from events import file_events
+from hub import CHUNKS_PER_FILE, chunk_size, sharder_hub
+from profiler import ProfilerBusy, allocation_diff, sample_stacks
+from recorder import TraceRecorder, annotate, file_key
+from scheduler import admission, scheduler
+from telemetry import span, stage
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -43,6 +52,9 @@ logger = logging.getLogger(__name__)
 CONNECTION_SECRET = (
     base64.b64encode(bytes.fromhex(os.environ["CONNECTION_SECRET"])).decode().strip("=")
 )
+MAX_BULK_FILES = int(os.environ.get("MAX_BULK_FILES", 1000))
+ARCHIVE_PREFETCH_BYTES = int(os.environ.get("ARCHIVE_PREFETCH_BYTES", 64 * 1024 * 1024))
+ARCHIVE_PREFETCH_CHUNKS = int(os.environ.get("ARCHIVE_PREFETCH_CHUNKS", 8))
 
 
 async def file_quantity_updater():
@@ -69,6 +81,16 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+if os.environ.get("TRACE_PATH"):
+    app.add_middleware(TraceRecorder, path=os.environ["TRACE_PATH"])
+
+
+class StagedResponse(Response):
+    """Response whose time spent handing the body to the server is a stage."""
+
+    async def __call__(self, scope, receive, send):
+        with stage("response"):
+            await super().__call__(scope, receive, send)
 
 
 class UploadResponse(BaseModel):
@@ -101,6 +123,49 @@ active_uploads = Gauge("sharder_active_uploads", "Ongoing uploads")
 total_uploads = Summary("sharder_total_uploads", "Total uploads")
 
 
+async def run_capture(func, *args) -> str:
+    # A dedicated thread keeps captures from taking executor slots
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def target():
+        try:
+            result = func(*args)
+        except Exception as e:
+            loop.call_soon_threadsafe(future.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(future.set_result, result)
+
+    Thread(target=target, name="profiler", daemon=True).start()
+    try:
+        return await future
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@app.get("/debug/profile", include_in_schema=False, dependencies=[Depends(use_admin)])
+async def profile(
+    seconds: Annotated[float, Query(gt=0, le=120)] = 10,
+    interval: Annotated[float, Query(ge=0.001, le=1)] = 0.005,
+):
+    stacks = await run_capture(sample_stacks, seconds, interval)
+    return PlainTextResponse(stacks)
+
+
+@app.get(
+    "/debug/allocations",
+    include_in_schema=False,
+    dependencies=[Depends(use_admin)],
+)
+async def allocations(
+    seconds: Annotated[float, Query(gt=0, le=120)] = 10,
+    limit: Annotated[int, Query(ge=1, le=500)] = 25,
+    frames: Annotated[int, Query(ge=1, le=64)] = 1,
+):
+    table = await run_capture(allocation_diff, seconds, limit, frames)
+    return PlainTextResponse(table)
+
+
 @app.get("/health")
 async def health():
     return {"status": "ok"}
@@ -206,29 +271,54 @@ async def connect(data: ConnectionInfo, connection_secret: str):
 async def upload_file(
     user: Annotated[UserAuth, Depends(use_auth)],
     file: UploadFile = File(...),
+    upload: str | None = None,
 ):
     active_uploads.inc()
     try:
-        contents = await file.read()
-        file_hmac = await asyncio.get_event_loop().run_in_executor(
-            None,
-            sharder_hub.send,
-            contents,
-        )
-        with SessionLocal() as db:
-            user = db.query(UserModel).filter(UserModel.id == user.id).first()
-            if not user:
-                raise HTTPException(status_code=401, detail="Invalid token")
-
-            file_record = FileModel(
-                name=file.filename,
-                size=len(contents),
-                hmac=file_hmac,
-                owner=user,
+        size = file.size or 0
+        progress = {"type": "progress", "upload": upload, "name": file.filename}
+        with span("sharder.upload", size=size), admission.admit(user.id, size):
+            with stage("body_read"):
+                contents = await file.read()
+            file_events.publish(
+                user.id,
+                {**progress, "stage": "received", "size": len(contents)},
+                replayable=False,
+            )
+            file_hmac = await scheduler.run(
+                user.id,
+                len(contents),
+                sharder_hub.send,
+                contents,
+            )
+            file_events.publish(
+                user.id,
+                {**progress, "stage": "stored", "size": len(contents)},
+                replayable=False,
             )
-            db.add(file_record)
-            db.commit()
-            db.refresh(file_record)
+            with stage("db_commit"), SessionLocal() as db:
+                user = db.query(UserModel).filter(UserModel.id == user.id).first()
+                if not user:
+                    raise HTTPException(status_code=401, detail="Invalid token")
+
+                file_record = FileModel(
+                    name=file.filename,
+                    size=len(contents),
+                    hmac=file_hmac,
+                    owner=user,
+                )
+                db.add(file_record)
+                db.commit()
+                db.refresh(file_record)
+                file_events.publish(
+                    file_record.owner_id,
+                    {
+                        "type": "upload",
+                        "file": FilePydantic.model_validate(file_record).model_dump(
+                            mode="json"
+                        ),
+                    },
+                )
 
         return UploadResponse(ulid=file_record.id)
     finally:
@@ -240,10 +330,12 @@ async def list_files(
     user: Annotated[UserAuth, Depends(use_auth)],
 ) -> list[FilePydantic]:
     with SessionLocal() as db:
-        return [
+        files = [
             FilePydantic.model_validate(file)
             for file in db.query(FileModel).filter(FileModel.owner_id == user.id).all()
         ]
+        annotate(count=len(files))
+        return files
 
 
 @app.get("/api/files/{file_id}")
@@ -258,33 +350,38 @@ async def get_file(file_id: str, user: Annotated[UserAuth, Depends(use_auth)]):
         if not file_record:
             return b"File not found"
 
-        contents = await asyncio.get_event_loop().run_in_executor(
-            None,
-            sharder_hub.reconstruct,
-            file_record.hmac,
-        )
+        with (
+            span("sharder.download", size=file_record.size),
+            admission.admit(user.id, file_record.size),
+        ):
+            contents = await scheduler.run(
+                user.id,
+                file_record.size,
+                sharder_hub.reconstruct,
+                file_record.hmac,
+            )
 
-    mime_type = magic.from_buffer(contents, mime=True)
+    with stage("mime_sniff"):
+        mime_type = magic.from_buffer(contents, mime=True)
     headers = {
         "Cache-Control": "public, max-age=31536000, immutable",
         "ETag": file_record.hmac,
     }
 
     if mime_type:
-        return Response(content=contents, media_type=mime_type, headers=headers)
-    else:
-        try:
-            return Response(
-                content=contents.decode("utf-8"),
-                media_type="text/plain",
-                headers=headers,
-            )
-        except UnicodeDecodeError:
-            return Response(
-                content=contents,
-                media_type="application/octet-stream",
-                headers=headers,
-            )
+        return StagedResponse(content=contents, media_type=mime_type, headers=headers)
+    try:
+        return StagedResponse(
+            content=contents.decode("utf-8"),
+            media_type="text/plain",
+            headers=headers,
+        )
+    except UnicodeDecodeError:
+        return StagedResponse(
+            content=contents,
+            media_type="application/octet-stream",
+            headers=headers,
+        )
 
 
 @app.delete("/api/files/{file_id}")
@@ -299,10 +396,197 @@ async def delete_file(file_id: str, user: Annotated[UserAuth, Depends(use_auth)]
             return {"message": "File not found"}
 
         hmac: str = file_record.hmac
+        annotate(size=file_record.size, chunks=CHUNKS_PER_FILE)
         db.delete(file_record)
         db.commit()
+        file_events.publish(user.id, {"type": "delete", "id": file_id})
         if not db.query(FileModel).filter(FileModel.hmac == hmac).first():
-            sharder_hub.destroy(bytes.fromhex(hmac))
+            await scheduler.run(user.id, 0, sharder_hub.destroy, bytes.fromhex(hmac))
+
+
+class ArchiveSink:
+    """Write-only file object that zipfile streams into, drained per chunk."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def archive_name(name: str, taken: set[str]) -> str:
+    name = name.replace("\\", "/").rsplit("/", 1)[-1] or "file"
+    stem, ext = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate in taken:
+        candidate = f"{stem} ({n}){ext}"
+        n += 1
+    taken.add(candidate)
+    return candidate
+
+
+async def stream_archive(user_id: str, files: list[FilePydantic], budget: int):
+    """Yield a ZIP of ``files``, starting with an empty piece once admitted.
+
+    Chunks are fetched in archive order, and the next ones (across file
+    boundaries) are already in flight while the current one is written out.
+    """
+    jobs: list[tuple[FilePydantic, int | None, bool]] = []
+    for file in files:
+        size = chunk_size(file.size)
+        # Chunks past the end of a small file are empty and never fetched
+        indexes = [i for i in range(CHUNKS_PER_FILE) if i * size < file.size]
+        jobs += [(file, i, i == indexes[-1]) for i in indexes] or [(file, None, True)]
+
+    pending: deque[tuple[int, asyncio.Task | None]] = deque()
+    queued = reserved = 0
+    sink = ArchiveSink()
+    taken: set[str] = set()
+    with admission.admit(user_id, budget):
+        yield b""
+        try:
+            archive = zipfile.ZipFile(sink, "w")
+            for file, index, last in jobs:
+                while queued < len(jobs) and len(pending) < ARCHIVE_PREFETCH_CHUNKS:
+                    ahead, ahead_index, _ = jobs[queued]
+                    cost = chunk_size(ahead.size) if ahead_index is not None else 0
+                    if pending and reserved + cost > budget:
+                        break
+                    task = None
+                    if ahead_index is not None:
+                        task = asyncio.create_task(
+                            scheduler.run(
+                                user_id,
+                                cost,
+                                sharder_hub.retrieve_chunk,
+                                ahead_index,
+                                bytes.fromhex(ahead.hmac),
+                            )
+                        )
+                    pending.append((cost, task))
+                    reserved += cost
+                    queued += 1
+
+                cost, task = pending.popleft()
+                chunk = await task if task else b""
+                reserved -= cost
+                if chunk is None:
+                    raise RuntimeError(
+                        f"Failed to reconstruct chunk {index} of {file.id}"
+                    )
+
+                if not index:
+                    info = zipfile.ZipInfo(
+                        archive_name(file.name, taken),
+                        date_time=file.created_at.timetuple()[:6],
+                    )
+                    info.file_size = file.size
+                    entry = archive.open(info, "w")
+                entry.write(chunk)
+                if last:
+                    entry.close()
+                yield sink.drain()
+            archive.close()
+            yield sink.drain()
+        except Exception as e:
+            # Headers are already sent, the client sees a truncated archive
+            logger.error(f"Failed to stream archive for {user_id}: {e}")
+            raise
+        finally:
+            for _, task in pending:
+                if task:
+                    task.cancel()
+
+
+@app.get("/api/archive")
+async def download_archive(
+    user: Annotated[UserAuth, Depends(use_auth)],
+    ids: Annotated[
+        list[str], Query(alias="id", min_length=1, max_length=MAX_BULK_FILES)
+    ],
+):
+    with SessionLocal() as db:
+        files = [
+            FilePydantic.model_validate(file)
+            for file in db.query(FileModel)
+            .filter(and_(FileModel.id.in_(ids), FileModel.owner_id == user.id))
+            .all()
+        ]
+    if not files:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    order = {file_id: i for i, file_id in enumerate(ids)}
+    files.sort(key=lambda file: order[file.id])
+    total = sum(file.size for file in files)
+    annotate(size=total, count=len(files), files=[file_key(f.id) for f in files])
+
+    # Only the prefetch window is held in memory, so that is what gets admitted
+    budget = min(
+        total,
+        max(ARCHIVE_PREFETCH_BYTES, max(chunk_size(file.size) for file in files)),
+    )
+    # Starting the generator takes the admission budget, so a rejection is
+    # still a plain 429 or 503 instead of a truncated archive
+    archive = stream_archive(user.id, files, budget)
+    await anext(archive)
+    return StreamingResponse(
+        archive,
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="sharder.zip"'},
+    )
+
+
+@app.delete("/api/files")
+async def delete_files(
+    user: Annotated[UserAuth, Depends(use_auth)],
+    ids: Annotated[
+        list[str], Query(alias="id", min_length=1, max_length=MAX_BULK_FILES)
+    ],
+):
+    with SessionLocal() as db:
+        records = (
+            db.query(FileModel)
+            .filter(and_(FileModel.id.in_(ids), FileModel.owner_id == user.id))
+            .all()
+        )
+        if not records:
+            return {"deleted": []}
+
+        deleted = [record.id for record in records]
+        hmacs = list({record.hmac for record in records})
+        annotate(
+            size=sum(record.size for record in records),
+            count=len(deleted),
+            files=[file_key(file_id) for file_id in deleted],
+        )
+        for record in records:
+            db.delete(record)
+        db.commit()
+
+        # One query for every hash still referenced by any file, of any user
+        referenced = {
+            hmac
+            for (hmac,) in db.query(FileModel.hmac)
+            .filter(FileModel.hmac.in_(hmacs))
+            .distinct()
+        }
+
+    for file_id in deleted:
+        file_events.publish(user.id, {"type": "delete", "id": file_id})
+
+    orphaned = [bytes.fromhex(hmac) for hmac in hmacs if hmac not in referenced]
+    if orphaned:
+        await scheduler.run(user.id, 0, sharder_hub.destroy_many, orphaned)
+    return {"deleted": deleted}
 
 
 @app.websocket("/api/shards")
@@ -318,6 +602,63 @@ async def websocket_status(websocket: WebSocket):
         await websocket.close()
 
 
+@app.websocket("/api/events")
+async def websocket_file_events(
+    websocket: WebSocket,
+    since: int | None = None,
+    epoch: str | None = None,
+):
+    try:
+        user = use_auth(websocket)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+
+    async def listen():
+        with suppress(WebSocketDisconnect):
+            while True:
+                await websocket.receive_text()
+
+    async def forward(queue: asyncio.Queue):
+        while (event := await queue.get()) is not None:
+            await websocket.send_json(event)
+        # Dropped for falling behind, the client reconnects and resumes
+        await websocket.close(code=4000)
+
+    with file_events.subscribe(user.id) as queue:
+        missed = None
+        if since is not None and epoch is not None:
+            missed = file_events.since(user.id, epoch, since)
+
+        tasks = []
+        try:
+            # On resume ``seq`` is where the client left off, the replay that
+            # follows brings it up to date
+            await websocket.send_json(
+                {
+                    "type": "sync",
+                    "epoch": file_events.epoch,
+                    "seq": since if missed is not None else file_events.seq(user.id),
+                    "resumed": missed is not None,
+                }
+            )
+            for event in missed or ():
+                await websocket.send_json(event)
+
+            tasks = [
+                asyncio.create_task(listen()),
+                asyncio.create_task(forward(queue)),
+            ]
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        except Exception:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
 @app.get("/api/healthcheck")
 async def plain_status():
     return JSONResponse(content="ok", status_code=sharder_hub.status_code)
@@ -0,0 +1,43 @@
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Iterator
+
+from prometheus_client import Histogram
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+tracer = trace.get_tracer("sharder") if trace else None
+
+stage_time = Histogram(
+    "sharder_stage_seconds",
+    "Time spent in each stage of the upload and download pipelines",
+    ["stage"],
+)
+
+
+def span(name: str, **attributes):
+    """OpenTelemetry span when the API is installed, a no-op otherwise."""
+    if tracer is None:
+        return nullcontext()
+    return tracer.start_as_current_span(name, attributes=attributes)
+
+
+def mark_failed(current, reason: str):
+    """Flag a span from ``span()`` as failed without an exception to record."""
+    if current is None:
+        return
+    current.set_attribute("error.type", reason)
+    current.set_status(trace.Status(trace.StatusCode.ERROR, reason))
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        with span(f"sharder.{name}"):
+            yield
+    finally:
+        stage_time.labels(name).observe(time.perf_counter() - started)
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# Server modules import each other by bare name, as when run from this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("HMAC_SECRET", os.urandom(16).hex())
+os.environ.setdefault("CONNECTION_SECRET", os.urandom(16).hex())
+os.environ.setdefault(
+    "DB_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'sharder.db')}"
+)
@@ -0,0 +1,102 @@
+import io
+import os
+import zipfile
+
+import pytest
+from fastapi.testclient import TestClient
+
+from benchmarks.shards import StandInShard
+from db import init_db
+from hub import sharder_hub
+from scheduler import admission
+from server import app
+
+
+@pytest.fixture(scope="module")
+def shards():
+    init_db()
+    shards = [StandInShard().start() for _ in range(3)]
+    for shard in shards:
+        sharder_hub.add_shard(shard.host, shard.port)
+    yield shards
+    for shard in shards:
+        shard.stop()
+
+
+@pytest.fixture
+def client(shards) -> TestClient:
+    client = TestClient(app)
+    name = os.urandom(8).hex()
+    response = client.post("/api/register", json={"username": name, "password": name})
+    client.cookies.set("auth_token", response.cookies["auth_token"].strip('"'))
+    client.user_id = client.get("/api/me").json()["id"]
+    return client
+
+
+def upload(client: TestClient, name: str, data: bytes) -> str:
+    response = client.post("/api/upload", files={"file": (name, data)})
+    assert response.status_code == 200
+    return response.json()["ulid"]
+
+
+def test_archive_round_trip(client):
+    files = [
+        ("a.txt", os.urandom(300_000)),
+        ("b.bin", os.urandom(1)),
+        ("a.txt", os.urandom(10)),
+        ("../empty", b""),
+    ]
+    ids = [upload(client, name, data) for name, data in files]
+
+    response = client.get("/api/archive", params=[("id", i) for i in ids])
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.testzip() is None
+    assert archive.namelist() == ["a.txt", "b.bin", "a (1).txt", "empty"]
+    assert [archive.read(name) for name in archive.namelist()] == [
+        data for _, data in files
+    ]
+    assert client.user_id not in admission._per_user
+
+
+def test_archive_missing_chunk_releases_admission(client, shards):
+    file_id = upload(client, "lost.bin", os.urandom(50_000))
+    for shard in shards:
+        shard._chunks.clear()
+
+    with pytest.raises(RuntimeError):
+        client.get("/api/archive", params={"id": file_id})
+    assert client.user_id not in admission._per_user
+    assert admission._in_flight == 0
+
+
+def test_archive_rejected_before_streaming(client):
+    file_id = upload(client, "big.bin", os.urandom(10_000))
+    with admission.admit(client.user_id, admission._user_budget):
+        response = client.get("/api/archive", params={"id": file_id})
+    assert response.status_code == 429
+    assert "Retry-After" in response.headers
+    assert client.user_id not in admission._per_user
+
+
+def test_bulk_delete_keeps_shared_chunks(client, shards):
+    shared = os.urandom(20_000)
+    first, second = upload(client, "x", shared), upload(client, "y", shared)
+    alone = upload(client, "z", os.urandom(20_000))
+    hmacs = {bytes.fromhex(file["hmac"]) for file in client.get("/api/files").json()}
+
+    def stored() -> set[bytes]:
+        return {key[0] for shard in shards for key in shard._chunks} & hmacs
+
+    response = client.request(
+        "DELETE", "/api/files", params=[("id", first), ("id", alone)]
+    )
+    assert sorted(response.json()["deleted"]) == sorted([first, alone])
+    assert client.get(f"/api/files/{second}").content == shared
+    assert len(stored()) == 1
+
+    client.request("DELETE", "/api/files", params={"id": second})
+    assert client.get("/api/files").json() == []
+    assert not stored()
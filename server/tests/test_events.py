@@ -0,0 +1,87 @@
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+from db import init_db
+from events import FileEventBus, file_events
+from server import app
+
+
+def test_since_replays_missed_events():
+    bus = FileEventBus(history=4, buffer=4)
+    for i in range(3):
+        bus.publish("user", {"type": "delete", "id": str(i)})
+    assert [event["seq"] for event in bus.since("user", bus.epoch, 1)] == [2, 3]
+    assert bus.since("user", bus.epoch, 3) == []
+
+
+def test_since_requires_refetch():
+    bus = FileEventBus(history=2, buffer=4)
+    for i in range(4):
+        bus.publish("user", {"type": "delete", "id": str(i)})
+    # Older than the history, from a previous process, or from the future
+    assert bus.since("user", bus.epoch, 1) is None
+    assert bus.since("user", "stale", 3) is None
+    assert bus.since("user", bus.epoch, 5) is None
+    assert bus.since("other", bus.epoch, 0) == []
+
+
+def test_progress_events_are_not_replayed():
+    bus = FileEventBus(history=4, buffer=4)
+    bus.publish("user", {"type": "progress"}, replayable=False)
+    assert bus.seq("user") == 0
+    assert bus.since("user", bus.epoch, 0) == []
+
+
+def test_overflow_drops_subscriber():
+    bus = FileEventBus(history=4, buffer=2)
+    with bus.subscribe("user") as queue:
+        for i in range(3):
+            bus.publish("user", {"type": "delete", "id": str(i)})
+        assert queue.get_nowait() is None
+        assert queue.empty()
+        # Dropped subscribers no longer receive events
+        bus.publish("user", {"type": "delete", "id": "3"})
+        assert queue.empty()
+
+
+@pytest.fixture
+def client() -> TestClient:
+    init_db()
+    client = TestClient(app)
+    name = os.urandom(8).hex()
+    response = client.post("/api/register", json={"username": name, "password": name})
+    client.cookies.set("auth_token", response.cookies["auth_token"].strip('"'))
+    client.user_id = client.get("/api/me").json()["id"]
+    return client
+
+
+def test_resume_replays_missed_events(client):
+    with client.websocket_connect("/api/events") as websocket:
+        sync = websocket.receive_json()
+    assert sync == {
+        "type": "sync",
+        "epoch": file_events.epoch,
+        "seq": 0,
+        "resumed": False,
+    }
+
+    file_events.publish(client.user_id, {"type": "delete", "id": "a"})
+    file_events.publish(client.user_id, {"type": "delete", "id": "b"})
+
+    path = f"/api/events?since=0&epoch={sync['epoch']}"
+    with client.websocket_connect(path) as websocket:
+        sync = websocket.receive_json()
+        missed = [websocket.receive_json(), websocket.receive_json()]
+    # Replayed events are newer than the sync, so a client keeps them
+    assert sync["resumed"] and sync["seq"] == 0
+    assert [(event["seq"], event["id"]) for event in missed] == [(1, "a"), (2, "b")]
+
+
+def test_stale_epoch_is_not_resumed(client):
+    file_events.publish(client.user_id, {"type": "delete", "id": "a"})
+    with client.websocket_connect("/api/events?since=0&epoch=stale") as websocket:
+        sync = websocket.receive_json()
+    assert not sync["resumed"]
+    assert sync["seq"] == file_events.seq(client.user_id)
@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+import recorder
+from benchmarks.shards import StandInShard
+from hub import CHUNKS_PER_FILE, DESTROY_BATCH, SharderHub
+
+
+class LegacyShard(StandInShard):
+    """Shard built before 0x05, which drops batch deletes unanswered."""
+
+    def _delete_batch(self, client):
+        pass
+
+
+def make_hub(*shards: StandInShard) -> SharderHub:
+    hub = SharderHub()
+    for shard in shards:
+        hub.add_shard(shard.host, shard.port)
+    return hub
+
+
+@pytest.fixture
+def shards():
+    shards = [StandInShard().start() for _ in range(3)]
+    yield shards
+    for shard in shards:
+        shard.stop()
+
+
+def test_send_and_reconstruct(shards):
+    hub = make_hub(*shards)
+    data = os.urandom(100_000)
+    file_hmac = hub.send(data)
+    assert hub.reconstruct(file_hmac) == data
+    assert sum(len(shard._chunks) for shard in shards) == 2 * CHUNKS_PER_FILE
+
+
+def test_send_fails_without_enough_replicas():
+    hub = make_hub(StandInShard().start(), StandInShard(failure_rate=1).start())
+    with pytest.raises(RuntimeError):
+        hub.send(b"data")
+
+
+def test_destroy_many_batches(shards):
+    hub = make_hub(*shards)
+    kept = hub.send(b"kept")
+    hmacs = [bytes.fromhex(hub.send(os.urandom(16))) for _ in range(3)]
+    # Padding past one batch, these hashes are not stored anywhere
+    hmacs += [os.urandom(32) for _ in range(DESTROY_BATCH)]
+    hub.destroy_many(hmacs)
+    remaining = {key[0] for shard in shards for key in shard._chunks}
+    assert remaining == {bytes.fromhex(kept)}
+
+
+def test_destroy_many_falls_back_on_legacy_shards():
+    shards = [LegacyShard().start(), LegacyShard().start()]
+    hub = make_hub(*shards)
+    hmacs = [bytes.fromhex(hub.send(os.urandom(16))) for _ in range(3)]
+    hub.destroy_many(hmacs)
+    assert not any(shard._chunks for shard in shards)
+
+
+def test_retrieve_records_missing_chunks_as_failed(shards):
+    file_hmac = make_hub(*shards).send(b"data")
+    # The empty shard is asked first for every chunk and answers 0x00
+    empty = StandInShard().start()
+    hub = make_hub(empty, *shards)
+    record = {}
+    token = recorder._current.set(record)
+    try:
+        assert hub.reconstruct(file_hmac) == b"data"
+    finally:
+        recorder._current.reset(token)
+        empty.stop()
+    retrieves = [(shard, ok) for shard, op, _, ok in record["shards"]]
+    empty_address = f"{empty.host}:{empty.port}"
+    assert {ok for shard, ok in retrieves if shard == empty_address} == {False}
+    assert [ok for _, ok in retrieves].count(True) == CHUNKS_PER_FILE
@@ -0,0 +1,169 @@
+import asyncio
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+from scheduler import AdmissionController, FairScheduler
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0.01)
+
+
+async def _run_in_order(scheduler: FairScheduler, jobs: list[tuple[str, int]]):
+    order = []
+    gate = threading.Event()
+    # Hold the only slot so every job below is queued before dispatching
+    blocker = asyncio.create_task(scheduler.run("gate", 0, gate.wait, 5))
+    await _settle()
+    tasks = [
+        asyncio.create_task(scheduler.run(key, cost, order.append, key))
+        for key, cost in jobs
+    ]
+    await _settle()
+    gate.set()
+    await asyncio.gather(blocker, *tasks)
+    return order
+
+
+def test_round_robin_between_users():
+    scheduler = FairScheduler(slots=1, quantum=10, max_queued=16)
+    jobs = [("a", 10)] * 3 + [("b", 10)] * 2
+    order = asyncio.run(_run_in_order(scheduler, jobs))
+    assert order == ["a", "b", "a", "b", "a"]
+
+
+def test_large_operations_wait_for_deficit():
+    scheduler = FairScheduler(slots=1, quantum=10, max_queued=16)
+    jobs = [("big", 30), ("small", 10), ("small", 10), ("small", 10)]
+    order = asyncio.run(_run_in_order(scheduler, jobs))
+    assert order.index("big") == 2
+
+
+def test_weights_scale_quantum():
+    scheduler = FairScheduler(slots=1, quantum=10, max_queued=16, weights={"a": 2})
+    jobs = [("a", 10)] * 4 + [("b", 10)] * 2
+    order = asyncio.run(_run_in_order(scheduler, jobs))
+    assert order == ["a", "a", "b", "a", "a", "b"]
+
+
+@pytest.mark.parametrize("weight", [0, -1, float("nan"), float("inf")])
+def test_weights_must_be_positive(weight):
+    with pytest.raises(ValueError):
+        FairScheduler(slots=1, quantum=10, max_queued=16, weights={"a": weight})
+
+
+def test_credit_for_large_operations_is_granted_at_once():
+    # One byte of credit per round, spinning through them would take minutes
+    scheduler = FairScheduler(slots=1, quantum=1, max_queued=16, weights={"b": 3})
+    jobs = [("a", 500_000_000), ("b", 900_000_000), ("c", 400_000_000)]
+    order = asyncio.run(_run_in_order(scheduler, jobs))
+    # b needs 300M rounds, c 400M and a 500M
+    assert order == ["b", "c", "a"]
+
+
+def test_user_queue_limit():
+    async def main():
+        scheduler = FairScheduler(slots=1, quantum=10, max_queued=2)
+        gate = threading.Event()
+        blocker = asyncio.create_task(scheduler.run("a", 0, gate.wait, 5))
+        await _settle()
+        queued = [asyncio.create_task(scheduler.run("a", 0, int)) for _ in range(2)]
+        await _settle()
+        with pytest.raises(HTTPException) as error:
+            await scheduler.run("a", 0, int)
+        assert error.value.status_code == 429
+        gate.set()
+        await asyncio.gather(blocker, *queued)
+
+    asyncio.run(main())
+
+
+def test_cancel_while_queued_frees_nothing():
+    async def main():
+        scheduler = FairScheduler(slots=1, quantum=10, max_queued=16)
+        gate = threading.Event()
+        blocker = asyncio.create_task(scheduler.run("a", 0, gate.wait, 5))
+        await _settle()
+        waiting = asyncio.create_task(scheduler.run("b", 0, int))
+        await _settle()
+        waiting.cancel()
+        await _settle()
+        assert scheduler._running == 1
+        assert "b" not in scheduler._queues
+        gate.set()
+        await blocker
+        assert scheduler._running == 0
+        assert not scheduler._queues and not scheduler._round
+
+    asyncio.run(main())
+
+
+def test_cancel_while_running_keeps_slot_until_thread_ends():
+    async def main():
+        scheduler = FairScheduler(slots=1, quantum=10, max_queued=16)
+        gate = threading.Event()
+        started = []
+        running = asyncio.create_task(scheduler.run("a", 0, gate.wait, 5))
+        await _settle()
+        running.cancel()
+        next_task = asyncio.create_task(scheduler.run("b", 0, started.append, 1))
+        await _settle()
+        # The thread still runs gate.wait, so the slot must stay taken
+        assert scheduler._running == 1
+        assert not started
+        gate.set()
+        await next_task
+        assert started == [1]
+        assert scheduler._running == 0
+        assert running.cancelled()
+
+    asyncio.run(main())
+
+
+def test_errors_propagate_and_release_slot():
+    async def main():
+        scheduler = FairScheduler(slots=1, quantum=10, max_queued=16)
+        with pytest.raises(ZeroDivisionError):
+            await scheduler.run("a", 0, lambda: 1 / 0)
+        await _settle()
+        assert scheduler._running == 0
+
+    asyncio.run(main())
+
+
+def test_admission_budgets():
+    admission = AdmissionController(budget=100, user_budget=60)
+    with admission.admit("a", 50):
+        with pytest.raises(HTTPException) as error:
+            with admission.admit("a", 20):
+                pass
+        assert error.value.status_code == 429
+        assert error.value.headers["Retry-After"]
+
+        with admission.admit("b", 40):
+            with pytest.raises(HTTPException) as error:
+                with admission.admit("c", 20):
+                    pass
+            assert error.value.status_code == 503
+
+    assert admission._in_flight == 0
+    assert not admission._per_user
+
+
+def test_admission_lets_oversized_request_through_when_idle():
+    admission = AdmissionController(budget=100, user_budget=60)
+    with admission.admit("a", 500):
+        assert admission._in_flight == 500
+    assert admission._in_flight == 0
+
+
+def test_admission_released_on_error():
+    admission = AdmissionController(budget=100, user_budget=60)
+    with pytest.raises(RuntimeError):
+        with admission.admit("a", 50):
+            raise RuntimeError
+    assert admission._in_flight == 0
+    assert not admission._per_user
@@ -0,0 +1,59 @@
+import json
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from benchmarks import simulate
+from recorder import file_key
+
+
+@pytest.mark.parametrize("exact", [False, True])
+def test_place_on_fewer_shards_than_replicas(exact):
+    cluster = simulate.Cluster(
+        np.array([1000]), replicas=2, rng=np.random.default_rng(0), exact=exact
+    )
+    owners = cluster.place(np.array([10, 20, 30]))
+    assert owners.tolist() == [[0, -1]] * 3
+
+
+def test_small_cluster_reports_shortfall(tmp_path, monkeypatch, capsys):
+    output = tmp_path / "simulation.json"
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["simulate", "--shards", "1", "--replicas", "2", "--chunks", "1"]
+        + ["--days", "1", "--uploads-per-day", "100", "--seed", "1"]
+        + ["--output", str(output)],
+    )
+    simulate.main()
+    final = json.loads(output.read_text())["timeline"][-1]
+    assert final["write_shortfall_replicas"] == final["chunks"]
+    assert final["bytes_at_risk"] == final["logical_bytes"]
+
+
+def test_trace_deletes_are_replayed(tmp_path, monkeypatch):
+    trace = tmp_path / "trace.jsonl"
+    # Half the traced files are deleted an hour after upload, one in bulk
+    records = [
+        {"t": 0, "op": "upload", "file": file_key("a"), "size": 1000},
+        {"t": 1, "op": "upload", "file": file_key("b"), "size": 1000},
+        {"t": 2, "op": "upload", "file": file_key("c"), "size": 1000},
+        {"t": 3, "op": "upload", "file": file_key("d"), "size": 1000},
+        {"t": 3600, "op": "delete", "file": file_key("a"), "size": 1000},
+        {"t": 3602, "op": "bulk_delete", "files": [file_key("c")], "size": 1000},
+    ]
+    trace.write_text("".join(json.dumps(record) + "\n" for record in records))
+    output = tmp_path / "simulation.json"
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["simulate", "--trace", str(trace), "--shards", "3", "--days", "3"]
+        + ["--uploads-per-day", "1000", "--seed", "1", "--output", str(output)],
+    )
+    simulate.main()
+    final = json.loads(output.read_text())["timeline"][-1]
+    deleted = final["deleted_bytes"] / final["uploaded_bytes"]
+    # Deletes are due a step after upload, so the last day is still stored
+    assert 0.2 < deleted < 0.45
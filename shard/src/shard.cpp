@@ -1,3 +1,4 @@
+#include <algorithm>
 #include <iostream>
 #include <filesystem>
 #include <fstream>
@@ -246,6 +247,10 @@ private:
                 std::cout << "Processing PING request" << std::endl;
                 handle_ping(client_fd);
                 break;
+            case 0x05:
+                std::cout << "Processing BATCH DELETE request" << std::endl;
+                handle_delete_batch(client_fd, header, bytes_read);
+                break;
             default:
                 std::cerr << "Error: Unknown message type: 0x" << std::hex << static_cast<int>(msg_type) << std::dec << std::endl;
             }
@@ -350,6 +355,53 @@ private:
         send(fd, &status, 1, 0);
     }
 
+    void handle_delete_batch(int fd, uint8_t *header, int header_len)
+    {
+        // 0x05, uint16 count, then count times uint16 hmac_len + hmac.
+        // Replies with one status byte per hmac, in order.
+        std::vector<uint8_t> buffer(header, header + header_len);
+        auto fill = [&](size_t size)
+        {
+            while (buffer.size() < size)
+            {
+                uint8_t part[4096];
+                int r = recv(fd, part, std::min(sizeof(part), size - buffer.size()), 0);
+                if (r <= 0)
+                    return false;
+                buffer.insert(buffer.end(), part, part + r);
+            }
+            return true;
+        };
+
+        if (!fill(3))
+            return;
+        uint16_t count = ntohs(*reinterpret_cast<uint16_t *>(&buffer[1]));
+
+        std::vector<uint8_t> statuses;
+        statuses.reserve(count);
+        size_t offset = 3;
+        for (uint16_t i = 0; i < count; ++i)
+        {
+            if (!fill(offset + 2))
+                return;
+            uint16_t hmac_len = ntohs(*reinterpret_cast<uint16_t *>(&buffer[offset]));
+            if (!fill(offset + 2 + hmac_len))
+                return;
+            std::string hmac(reinterpret_cast<char *>(&buffer[offset + 2]), hmac_len);
+            offset += 2 + hmac_len;
+
+            std::string hex_hmac;
+            for (char c : hmac)
+            {
+                char buf[3];
+                snprintf(buf, sizeof(buf), "%02x", static_cast<unsigned char>(c));
+                hex_hmac += buf;
+            }
+            statuses.push_back(disk.destroy(hex_hmac) ? 0x01 : 0x00);
+        }
+        send(fd, statuses.data(), statuses.size(), 0);
+    }
+
     void handle_ping(int fd)
     {
         uint32_t s = htonl(disk.size());